@@ -1,15 +1,82 @@
 import streamlit as st
-import gspread
-from google.oauth2.service_account import Credentials
-from datetime import datetime
-import pandas as pd
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+from datetime import datetime, timedelta
+import bisect
+import concurrent.futures
+import contextlib
+import functools
+from collections import Counter, defaultdict, deque
+from array import array
+import base64
+import glob
+import gzip
 import hashlib
+import hmac
+import importlib
+import io
+import json
+import logging
+import os
+import random
+import re
+import secrets
+import sqlite3
+import threading
 import time
 
+
+class ModuloDiferido:
+    """
+    Módulo que se importa la primera vez que se lee uno de sus atributos.
+    Así la pantalla de login se pinta sin esperar a gspread, google-auth ni
+    openpyxl, que se cargan en segundo plano mientras el usuario escribe.
+    """
+
+    def __init__(self, nombre):
+        self._nombre = nombre
+        self._modulo = None
+
+    def __getattr__(self, atributo):
+        if self._modulo is None:
+            self._modulo = importlib.import_module(self._nombre)
+        return getattr(self._modulo, atributo)
+
+
+gspread = ModuloDiferido("gspread")
+requests = ModuloDiferido("requests")
+service_account = ModuloDiferido("google.oauth2.service_account")
+auth_exceptions = ModuloDiferido("google.auth.exceptions")
+auth_requests = ModuloDiferido("google.auth.transport.requests")
+np = ModuloDiferido("numpy")
+pd = ModuloDiferido("pandas")
+pa = ModuloDiferido("pyarrow")
+pq = ModuloDiferido("pyarrow.parquet")
+openpyxl = ModuloDiferido("openpyxl")
+
 # ============================================================================
 # CONFIGURACIÓN
 # ============================================================================
 
+logger = logging.getLogger("ismr")
+
+
+def configurar_logs():
+    """
+    Envía el logger "ismr" a stderr, una línea por evento (los reruns van
+    como JSON), con el nivel del secret `nivel_log` (INFO por defecto).
+    Streamlit re-ejecuta el script en cada rerun: el handler se agrega una vez.
+    """
+    if not logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+        logger.addHandler(handler)
+        # Sin pasar por los handlers de Streamlit, que lo repetirían
+        logger.propagate = False
+    logger.setLevel(str(st.secrets.get("nivel_log", "INFO")).upper())
+
+
+configurar_logs()
+
 st.set_page_config(
     page_title="Sistema ISMR",
     page_icon="📋",
@@ -33,506 +100,2331 @@ for key, val in defaults.items():
 # CSS - PANTALLA DE SELECCIÓN
 # ============================================================================
 
+# Hoja de estilos de la pantalla de selección; las fuentes van en static/fonts
+RUTA_CSS_SELECTOR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static", "css", "selector.css")
+
+
+@functools.cache
+def css_selector():
+    """La hoja de estilos minificada y envuelta en <style>, leída una vez por proceso."""
+    with open(RUTA_CSS_SELECTOR, encoding="utf-8") as f:
+        css = f.read()
+    css = re.sub(r"/\*.*?\*/", "", css, flags=re.DOTALL)
+    css = re.sub(r"\s+", " ", css)
+    css = re.sub(r"\s*([{};,>])\s*", r"\1", css).replace(": ", ":").replace(";}", "}")
+    return f"<style>{css.strip()}</style>"
+
+
 def inyectar_css_selector():
-    st.markdown("""
-    <style>
-        @import url('https://fonts.googleapis.com/css2?family=Bebas+Neue&family=DM+Sans:wght@300;400;500;600&display=swap');
+    # Siempre el mismo mensaje: Streamlit lo manda completo una vez por sesión
+    # y en cada rerun solo su hash (global.minCachedMessageSize)
+    st.markdown(css_selector(), unsafe_allow_html=True)
 
-        /* Reset y base */
-        .stApp {
-            background: #0A0A0F;
-        }
 
-        /* Ocultar elementos por defecto de Streamlit en pantalla selector */
-        #MainMenu, footer, header { visibility: hidden; }
-
-        /* Contenedor principal del selector */
-        .selector-wrapper {
-            min-height: 100vh;
-            display: flex;
-            flex-direction: column;
-            align-items: center;
-            justify-content: center;
-            padding: 20px;
-            font-family: 'DM Sans', sans-serif;
-            background: #0A0A0F;
-        }
+# ============================================================================
+# MÉTRICAS DE RENDIMIENTO
+# ============================================================================
 
-        /* Header del selector */
-        .selector-header {
-            text-align: center;
-            margin-bottom: 48px;
-        }
+# Mediciones que se conservan por nombre para calcular percentiles
+MUESTRAS_RENDIMIENTO = 500
+# Reruns recientes que se listan en el panel de rendimiento
+ACCIONES_RECIENTES = 50
 
-        .selector-header .greeting {
-            font-family: 'DM Sans', sans-serif;
-            font-weight: 300;
-            font-size: 14px;
-            letter-spacing: 4px;
-            text-transform: uppercase;
-            color: #666;
-            margin-bottom: 8px;
-        }
+# Contadores del rerun en curso; las tareas del pool heredan los de quien las encargó
+_hilo_local = threading.local()
 
-        .selector-header .user-name {
-            font-family: 'Bebas Neue', sans-serif;
-            font-size: clamp(28px, 5vw, 42px);
-            letter-spacing: 3px;
-            color: #F0F0F0;
-            margin-bottom: 4px;
-        }
 
-        .selector-header .subtitle {
-            font-size: 13px;
-            color: #555;
-            letter-spacing: 1px;
-        }
+class MetricasRendimiento:
+    """
+    Tiempos y contadores de todo el proceso. De cada medición se guardan
+    las últimas MUESTRAS_RENDIMIENTO, de donde salen p50 y p95.
+    """
 
-        /* Grid de botones */
-        .selector-grid {
-            display: grid;
-            grid-template-columns: 1fr 1fr;
-            gap: 20px;
-            width: 100%;
-            max-width: 860px;
-        }
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tiempos = defaultdict(lambda: deque(maxlen=MUESTRAS_RENDIMIENTO))
+        self.contadores = Counter()
+        self.acciones = deque(maxlen=ACCIONES_RECIENTES)
+
+    def registrar(self, nombre, segundos):
+        with self.lock:
+            self.tiempos[nombre].append(segundos)
+
+    def contar(self, nombre, n=1):
+        with self.lock:
+            self.contadores[nombre] += n
+
+    def registrar_accion(self, accion):
+        with self.lock:
+            self.acciones.append(accion)
+
+    def percentiles(self):
+        with self.lock:
+            tiempos = {nombre: np.array(valores) for nombre, valores in self.tiempos.items()}
+        return [
+            {
+                "Medición": nombre,
+                "Muestras": len(valores),
+                "p50 (ms)": round(float(np.percentile(valores, 50)) * 1000, 1),
+                "p95 (ms)": round(float(np.percentile(valores, 95)) * 1000, 1),
+                "Máx (ms)": round(float(valores.max()) * 1000, 1),
+            }
+            for nombre, valores in sorted(tiempos.items()) if len(valores)
+        ]
 
-        /* Cada tarjeta de selección */
-        .selector-card {
-            position: relative;
-            border-radius: 4px;
-            padding: 60px 40px;
-            cursor: pointer;
-            overflow: hidden;
-            transition: transform 0.3s ease, box-shadow 0.3s ease;
-            text-decoration: none;
-            display: flex;
-            flex-direction: column;
-            align-items: flex-start;
-            justify-content: flex-end;
-            min-height: 340px;
-            border: 1px solid transparent;
-        }
+    def tasas_cache(self):
+        with self.lock:
+            contadores = dict(self.contadores)
+        return [
+            {
+                "Caché": clave.split(".")[1],
+                "Consultas": consultas,
+                "Fallos": contadores.get(clave[:-len("consultas")] + "fallos", 0),
+                "Aciertos (%)": round(100 * (1 - contadores.get(clave[:-len("consultas")] + "fallos", 0) / consultas), 1),
+            }
+            for clave, consultas in sorted(contadores.items())
+            if clave.startswith("cache.") and clave.endswith(".consultas") and consultas
+        ]
 
-        .selector-card:hover {
-            transform: translateY(-4px);
-        }
+    def reiniciar(self):
+        with self.lock:
+            self.tiempos.clear()
+            self.contadores.clear()
+            self.acciones.clear()
 
-        /* Tarjeta INDIVIDUAL */
-        .card-individual {
-            background: linear-gradient(145deg, #1A1A2E 0%, #16213E 50%, #0F3460 100%);
-            border-color: rgba(79, 139, 255, 0.15);
-            box-shadow: 0 0 0 0 rgba(79, 139, 255, 0);
-        }
 
-        .card-individual:hover {
-            box-shadow: 0 20px 60px rgba(79, 139, 255, 0.15),
-                        inset 0 0 80px rgba(79, 139, 255, 0.05);
-            border-color: rgba(79, 139, 255, 0.4);
-        }
+@st.cache_resource(show_spinner=False)
+def metricas_rendimiento():
+    return MetricasRendimiento()
 
-        .card-individual .card-accent {
-            position: absolute;
-            top: 0; left: 0; right: 0;
-            height: 2px;
-            background: linear-gradient(90deg, transparent, #4F8BFF, transparent);
-        }
 
-        .card-individual .card-number {
-            color: rgba(79, 139, 255, 0.25);
-        }
+def contar(nombre, n=1):
+    """Suma `n` al contador del proceso y al del rerun en curso, si hay uno."""
+    metricas_rendimiento().contar(nombre, n)
+    accion = getattr(_hilo_local, "accion", None)
+    if accion is not None:
+        accion[nombre] += n
 
-        .card-individual .card-icon-bg {
-            background: rgba(79, 139, 255, 0.08);
-            border: 1px solid rgba(79, 139, 255, 0.15);
-        }
 
-        .card-individual .card-icon {
-            color: #4F8BFF;
-        }
+def contar_cache(nombre, acierto):
+    contar(f"cache.{nombre}.consultas")
+    if not acierto:
+        contar(f"cache.{nombre}.fallos")
 
-        .card-individual .card-title {
-            color: #E8EEFF;
-        }
 
-        .card-individual .card-desc {
-            color: rgba(200, 210, 255, 0.45);
-        }
+@contextlib.contextmanager
+def medir(nombre):
+    """Registra la duración del bloque (o de la función decorada) bajo `nombre`."""
+    inicio = time.perf_counter()
+    try:
+        yield
+    finally:
+        segundos = time.perf_counter() - inicio
+        metricas_rendimiento().registrar(nombre, segundos)
+        logger.debug(json.dumps({"evento": "tiempo", "nombre": nombre, "ms": round(segundos * 1000, 1)}))
 
-        .card-individual .card-arrow {
-            color: #4F8BFF;
-            border-color: rgba(79, 139, 255, 0.3);
-        }
 
-        /* Tarjeta COLECTIVO */
-        .card-colectivo {
-            background: linear-gradient(145deg, #1A1A1A 0%, #1E2A1E 50%, #0A3D0A 100%);
-            border-color: rgba(74, 222, 128, 0.12);
-            box-shadow: 0 0 0 0 rgba(74, 222, 128, 0);
-        }
+def registrar_respuesta_http(respuesta, *args, **kwargs):
+    """Hook de la sesión HTTP del cliente: cuenta peticiones y bytes recibidos."""
+    contar("sheets.peticiones")
+    if not kwargs.get("stream"):
+        contar("sheets.bytes", len(respuesta.content))
 
-        .card-colectivo:hover {
-            box-shadow: 0 20px 60px rgba(74, 222, 128, 0.12),
-                        inset 0 0 80px rgba(74, 222, 128, 0.04);
-            border-color: rgba(74, 222, 128, 0.35);
-        }
 
-        .card-colectivo .card-accent {
-            position: absolute;
-            top: 0; left: 0; right: 0;
-            height: 2px;
-            background: linear-gradient(90deg, transparent, #4ADE80, transparent);
+@contextlib.contextmanager
+def accion_usuario():
+    """
+    Agrupa lo que cuesta un rerun: duración y llamadas, peticiones y bytes
+    de Sheets, incluidas las tareas que encarga al pool. Al terminar queda
+    como una línea JSON en el log y en el panel de rendimiento.
+    """
+    _hilo_local.accion = accion = Counter()
+    _hilo_local.pantalla = None
+    inicio = time.perf_counter()
+    try:
+        yield
+    finally:
+        _hilo_local.accion = None
+        segundos = time.perf_counter() - inicio
+        registro = {
+            "evento": "rerun",
+            "hora": datetime.now().strftime("%H:%M:%S"),
+            "usuario": st.session_state.get("username"),
+            "pantalla": getattr(_hilo_local, "pantalla", None),
+            "ms": round(segundos * 1000, 1),
+            "llamadas_sheets": accion["sheets.llamadas"],
+            "peticiones_http": accion["sheets.peticiones"],
+            "bytes": accion["sheets.bytes"],
         }
+        metricas = metricas_rendimiento()
+        metricas.registrar("rerun", segundos)
+        metricas.registrar_accion(registro)
+        logger.info(json.dumps(registro, ensure_ascii=False))
 
-        .card-colectivo .card-number {
-            color: rgba(74, 222, 128, 0.2);
-        }
 
-        .card-colectivo .card-icon-bg {
-            background: rgba(74, 222, 128, 0.07);
-            border: 1px solid rgba(74, 222, 128, 0.15);
-        }
+def etapa(nombre):
+    """Decorador de las pantallas: mide su render y la anota en el rerun."""
+    def decorador(funcion):
+        @functools.wraps(funcion)
+        def envoltura(*args, **kwargs):
+            _hilo_local.pantalla = nombre
+            with medir(f"render.{nombre}"):
+                return funcion(*args, **kwargs)
+        return envoltura
+    return decorador
 
-        .card-colectivo .card-icon {
-            color: #4ADE80;
-        }
 
-        .card-colectivo .card-title {
-            color: #E8FFE8;
-        }
+# ============================================================================
+# GOOGLE SHEETS - CONEXIÓN COMPARTIDA
+# ============================================================================
 
-        .card-colectivo .card-desc {
-            color: rgba(200, 255, 200, 0.4);
-        }
+SCOPES = [
+    "https://www.googleapis.com/auth/spreadsheets",
+    "https://www.googleapis.com/auth/drive"
+]
 
-        .card-colectivo .card-arrow {
-            color: #4ADE80;
-            border-color: rgba(74, 222, 128, 0.3);
-        }
+# Segundos antes del vencimiento en los que el token se renueva por adelantado
+MARGEN_RENOVACION_TOKEN = 300
+# Segundos que se espera la respuesta de cada petición HTTP a la API
+TIMEOUT_SHEETS = 30
 
-        /* Elementos internos de cada card */
-        .card-number {
-            position: absolute;
-            top: 28px;
-            right: 32px;
-            font-family: 'Bebas Neue', sans-serif;
-            font-size: 80px;
-            line-height: 1;
-            letter-spacing: -2px;
-            pointer-events: none;
-        }
+# Errores de red tras los cuales se reconstruye la sesión HTTP
+def errores_conexion():
+    return (requests.exceptions.ConnectionError, requests.exceptions.Timeout, auth_exceptions.TransportError)
 
-        .card-icon-bg {
-            width: 52px;
-            height: 52px;
-            border-radius: 3px;
-            display: flex;
-            align-items: center;
-            justify-content: center;
-            margin-bottom: 28px;
-        }
 
-        .card-icon {
-            font-size: 22px;
-        }
+class PoolSheets:
+    """
+    Cliente de gspread compartido por todas las sesiones del proceso.
+    Autoriza una sola vez, renueva el token antes de que venza y
+    mantiene abiertos los spreadsheets que ya se usaron.
+    """
 
-        .card-title {
-            font-family: 'Bebas Neue', sans-serif;
-            font-size: clamp(26px, 3.5vw, 34px);
-            letter-spacing: 3px;
-            margin-bottom: 10px;
-            line-height: 1;
-        }
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.credentials = None
+        self.client = None
+        self.transporte_token = None
+        self.spreadsheets = {}
+        self.worksheets = {}
+        self.esquemas_verificados = set()
+        self.locks = {}
+
+    def _construir(self):
+        credentials_dict = st.secrets["gcp_service_account"]
+        self.credentials = service_account.Credentials.from_service_account_info(credentials_dict, scopes=SCOPES)
+        self.client = gspread.authorize(self.credentials)
+        self.client.set_timeout(st.secrets.get("timeout_sheets", TIMEOUT_SHEETS))
+        self.client.session.hooks["response"].append(registrar_respuesta_http)
+        # El token se pide con una sesión sin credenciales: por la
+        # AuthorizedSession viajaría el token vencido y ella misma volvería
+        # a renovarlo antes de la petición
+        self.transporte_token = auth_requests.Request()
+        self.spreadsheets = {}
+        self.worksheets = {}
+
+    def _lock_de(self, clave):
+        """
+        Lock propio de un spreadsheet, pestaña o esquema: abrir uno no
+        frena a los hilos que piden otro.
+        """
+        with self.lock:
+            return self.locks.setdefault(clave, threading.Lock())
+
+    def _token_por_vencer(self):
+        if not self.credentials.token or self.credentials.expiry is None:
+            return True
+        return self.credentials.expiry - datetime.utcnow() < timedelta(seconds=MARGEN_RENOVACION_TOKEN)
+
+    def renovar_token(self, forzar=False):
+        with self.lock:
+            if self.client is None:
+                self._construir()
+            if forzar or self._token_por_vencer():
+                self.credentials.refresh(self.transporte_token)
+
+    def obtener_cliente(self):
+        with self.lock:
+            self.renovar_token()
+            return self.client
+
+    def abrir(self, nombre, crear_si_falta=False):
+        """Devuelve el spreadsheet `nombre`, abriéndolo solo la primera vez."""
+        client = self.obtener_cliente()
+        with self._lock_de(("spreadsheet", nombre)):
+            spreadsheet = self.spreadsheets.get(nombre)
+            if spreadsheet is None:
+                try:
+                    spreadsheet = client.open(nombre)
+                except gspread.exceptions.SpreadsheetNotFound:
+                    if not crear_si_falta:
+                        raise
+                    spreadsheet = client.create(nombre)
+                    # El libro nuevo es de la cuenta de servicio: sin compartirlo
+                    # nadie más lo ve
+                    correos = st.secrets.get("correos_admin", [])
+                    for correo in [correos] if isinstance(correos, str) else correos:
+                        spreadsheet.share(correo, perm_type='user', role='writer', notify=False)
+                    if not correos:
+                        logger.warning("sheets: %s creado sin correos_admin, solo lo ve la cuenta de servicio",
+                                       nombre)
+                self.spreadsheets[nombre] = spreadsheet
+            return spreadsheet
+
+    def worksheet(self, nombre, tab=None, crear_si_falta=False):
+        """
+        Devuelve la pestaña `tab` del spreadsheet `nombre` (la primera si
+        tab es None). El handle se resuelve una sola vez por proceso.
+        """
+        clave = (nombre, tab)
+        with self._lock_de(("worksheet", clave)):
+            worksheet = self.worksheets.get(clave)
+            contar_cache("worksheets", worksheet is not None)
+            if worksheet is None:
+                spreadsheet = self.abrir(nombre, crear_si_falta=crear_si_falta)
+                if tab is None:
+                    worksheet = spreadsheet.sheet1
+                else:
+                    try:
+                        worksheet = spreadsheet.worksheet(tab)
+                    except gspread.exceptions.WorksheetNotFound:
+                        worksheet = spreadsheet.add_worksheet(title=tab, rows="1000", cols="20")
+                self.worksheets[clave] = worksheet
+            return worksheet
+
+    def verificar_esquema(self, worksheet, headers, reescribir=False):
+        """
+        Comprueba los encabezados de la fila 1 la primera vez que se usa la
+        pestaña en el proceso. Si está vacía los escribe; si difieren y
+        `reescribir` es True los reemplaza.
+        """
+        clave = (worksheet.spreadsheet.id, worksheet.title)
+        if clave in self.esquemas_verificados:
+            return
+        with self._lock_de(("esquema", clave)):
+            if clave in self.esquemas_verificados:
+                return
+            current_headers = llamar_sheets(worksheet.row_values, 1)
+            if not current_headers:
+                llamar_sheets(worksheet.append_row, headers)
+            elif reescribir and current_headers != headers:
+                llamar_sheets(worksheet.update, 'A1', [headers])
+            self.esquemas_verificados.add(clave)
+
+    def reverificar_esquemas(self):
+        """Olvida handles y esquemas verificados; se revisan en el próximo uso."""
+        with self.lock:
+            self.worksheets = {}
+            self.esquemas_verificados = set()
+
+    def reconectar(self):
+        """
+        Reemplaza la sesión HTTP del cliente sin invalidar los handles
+        abiertos: los spreadsheets y worksheets apuntan al mismo cliente.
+        """
+        with self.lock:
+            if self.client is None:
+                self._construir()
+                return
+            self.client.session.close()
+            self.client.session = auth_requests.AuthorizedSession(self.credentials)
+            self.client.session.hooks["response"].append(registrar_respuesta_http)
+            self.renovar_token(forzar=True)
+
+
+@st.cache_resource(show_spinner=False)
+def pool_sheets():
+    return PoolSheets()
+
+
+# Cuotas por minuto de la API de Sheets para una misma cuenta de servicio
+CUOTA_LECTURAS_MINUTO = 60
+CUOTA_ESCRITURAS_MINUTO = 60
+# Métodos de gspread que consumen cuota de escritura; el resto, de lectura
+ESCRITURAS_SHEETS = {
+    "append_row", "append_rows", "insert_row", "insert_rows", "update", "update_cell",
+    "update_cells", "batch_update", "batch_clear", "clear", "delete_rows", "add_worksheet",
+    "values_append", "values_update", "values_batch_update",
+}
+# Reintentos ante cuota agotada, fallas del servidor o caídas de conexión
+REINTENTOS_SHEETS = 5
+CODIGOS_REINTENTABLES = {429, 500, 502, 503, 504}
+# Métodos que agregan filas: tras un timeout o un 5xx la escritura pudo
+# haberse aplicado, y repetirla duplicaría los casos. Solo se reintentan
+# ante 429, que Sheets rechaza sin aplicar nada
+AGREGADOS_SHEETS = {"append_row", "append_rows", "insert_row", "insert_rows", "values_append"}
+# Segundos de la primera espera entre reintentos (se duplica en cada uno) y tope
+ESPERA_BASE_REINTENTO = 1.0
+ESPERA_MAXIMA_REINTENTO = 32.0
+
+
+class LimitadorCuota:
+    """
+    Ventana deslizante de 60 s compartida por todas las sesiones del
+    proceso: en ningún minuto pasan más de `por_minuto` llamadas, como
+    cuenta la cuota de Sheets. Quien llega con la ventana llena espera a
+    que salga la llamada más antigua.
+    """
 
-        .card-desc {
-            font-size: 12px;
-            letter-spacing: 0.5px;
-            line-height: 1.6;
-            margin-bottom: 32px;
-            font-weight: 300;
-        }
+    def __init__(self, por_minuto):
+        self.lock = threading.Lock()
+        self.por_minuto = por_minuto
+        self.llamadas = deque()
+
+    def tomar(self):
+        while True:
+            with self.lock:
+                ahora = time.monotonic()
+                while self.llamadas and ahora - self.llamadas[0] >= 60:
+                    self.llamadas.popleft()
+                if len(self.llamadas) < self.por_minuto:
+                    self.llamadas.append(ahora)
+                    return
+                espera = 60 - (ahora - self.llamadas[0])
+            time.sleep(espera)
+
+
+@st.cache_resource(show_spinner=False)
+def limitadores_sheets():
+    return {
+        "lectura": LimitadorCuota(st.secrets.get("cuota_lecturas_minuto", CUOTA_LECTURAS_MINUTO)),
+        "escritura": LimitadorCuota(st.secrets.get("cuota_escrituras_minuto", CUOTA_ESCRITURAS_MINUTO)),
+    }
+
+
+def llamar_sheets(funcion, *args, **kwargs):
+    """
+    Ejecuta una llamada a la API de Sheets con el cliente compartido, previo
+    turno en el limitador de lecturas o de escrituras. Ante cuota agotada
+    (429), errores 5xx o caídas de conexión reintenta con espera exponencial
+    con jitter; si el token fue rechazado lo renueva y reintenta. Los
+    métodos de AGREGADOS_SHEETS solo se reintentan ante 429.
+    """
+    pool = pool_sheets()
+    # Los métodos del pool abren spreadsheets y pestañas una vez por
+    # proceso; no pasan por el limitador
+    limitador = None
+    if not isinstance(getattr(funcion, "__self__", None), PoolSheets):
+        limitador = limitadores_sheets()["escritura" if funcion.__name__ in ESCRITURAS_SHEETS else "lectura"]
+    agregado = funcion.__name__ in AGREGADOS_SHEETS
+    token_renovado = False
+    intento = 0
+    while True:
+        pool.renovar_token()
+        if limitador:
+            with medir("sheets.espera_cuota"):
+                limitador.tomar()
+        contar("sheets.llamadas")
+        try:
+            with medir(f"sheets.{funcion.__name__}"):
+                return funcion(*args, **kwargs)
+        except errores_conexion() as e:
+            if intento == REINTENTOS_SHEETS or agregado:
+                raise
+            error = e
+            pool.reconectar()
+        except gspread.exceptions.APIError as e:
+            codigo = e.response.status_code
+            if codigo == 401 and not token_renovado:
+                # Reintento inmediato con token nuevo: no cuenta como intento
+                token_renovado = True
+                pool.renovar_token(forzar=True)
+                continue
+            if (codigo not in CODIGOS_REINTENTABLES or intento == REINTENTOS_SHEETS
+                    or agregado and codigo != 429):
+                raise
+            error = e
+        contar("sheets.reintentos")
+        espera = random.uniform(0, min(ESPERA_MAXIMA_REINTENTO, ESPERA_BASE_REINTENTO * 2 ** intento))
+        logger.warning("sheets: %s falló (%s), reintento %d en %.1f s",
+                       funcion.__name__, error, intento + 1, espera)
+        time.sleep(espera)
+        intento += 1
 
-        .card-arrow {
-            font-size: 11px;
-            letter-spacing: 3px;
-            text-transform: uppercase;
-            padding: 8px 18px;
-            border-radius: 2px;
-            border: 1px solid;
-        }
+# ============================================================================
+# GOOGLE SHEETS - USUARIOS
+# ============================================================================
 
-        /* Footer del selector */
-        .selector-footer {
-            margin-top: 40px;
-            display: flex;
-            align-items: center;
-            gap: 16px;
-        }
+ENCABEZADOS_USUARIOS = ["username", "password_hash", "nombre_completo", "es_admin", "debe_cambiar_password"]
 
-        .logout-btn-wrapper button {
-            background: transparent !important;
-            border: 1px solid #333 !important;
-            color: #555 !important;
-            font-size: 11px !important;
-            letter-spacing: 2px !important;
-            text-transform: uppercase !important;
-            padding: 8px 20px !important;
-            border-radius: 2px !important;
-            transition: all 0.2s !important;
-        }
 
-        .logout-btn-wrapper button:hover {
-            border-color: #666 !important;
-            color: #999 !important;
-        }
+def conectar_sheet_usuarios():
+    """
+    Pestaña de usuarios con el esquema verificado. Los errores de Sheets se
+    propagan: quien llama decide cómo mostrarlos (y desde un hilo no se dibuja).
+    """
+    pool = pool_sheets()
+    sheet_name = st.secrets.get("sheet_usuarios", "ISMR_Usuarios")
+    worksheet = llamar_sheets(pool.worksheet, sheet_name, crear_si_falta=True)
+    pool.verificar_esquema(worksheet, ENCABEZADOS_USUARIOS)
+    return worksheet
 
-        /* Botones Streamlit para las tarjetas */
-        .btn-individual > button,
-        .btn-colectivo > button {
-            width: 100% !important;
-            min-height: 340px !important;
-            border-radius: 4px !important;
-            border: 1px solid !important;
-            transition: all 0.3s ease !important;
-            font-family: 'Bebas Neue', sans-serif !important;
-            letter-spacing: 3px !important;
-            font-size: 28px !important;
-        }
+# Segundos que el directorio en memoria se considera vigente
+TTL_DIRECTORIO_USUARIOS = 300
 
-        .btn-individual > button {
-            background: linear-gradient(145deg, #1A1A2E 0%, #16213E 50%, #0F3460 100%) !important;
-            border-color: rgba(79, 139, 255, 0.3) !important;
-            color: #E8EEFF !important;
-        }
 
-        .btn-individual > button:hover {
-            border-color: rgba(79, 139, 255, 0.7) !important;
-            box-shadow: 0 20px 60px rgba(79, 139, 255, 0.2) !important;
-            transform: translateY(-4px) !important;
-        }
+class DirectorioUsuarios:
+    """
+    Índice en memoria de la hoja de usuarios, por username, con el número
+    de fila de cada uno para escribirle sin buscarlo en la hoja.
+    Se recarga completo cuando vence el TTL; las escrituras propias
+    (crear usuario, cambiar contraseña) lo actualizan al instante.
+    """
 
-        .btn-colectivo > button {
-            background: linear-gradient(145deg, #1A1A1A 0%, #1E2A1E 50%, #0A3D0A 100%) !important;
-            border-color: rgba(74, 222, 128, 0.25) !important;
-            color: #E8FFE8 !important;
-        }
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.usuarios = {}
+        self.filas = {}
+        self.cargado_en = None
 
-        .btn-colectivo > button:hover {
-            border-color: rgba(74, 222, 128, 0.6) !important;
-            box-shadow: 0 20px 60px rgba(74, 222, 128, 0.15) !important;
-            transform: translateY(-4px) !important;
-        }
+    def vigente(self, ttl):
+        return self.cargado_en is not None and time.monotonic() - self.cargado_en < ttl
 
-        /* Estilos para los formularios */
-        .form-header {
-            display: flex;
-            align-items: center;
-            gap: 12px;
-            margin-bottom: 8px;
-        }
+    def cargar(self, registros):
+        """`registros` de get_all_records: el primero es la fila 2 de la hoja."""
+        with self.lock:
+            self.usuarios = {}
+            self.filas = {}
+            for fila, u in enumerate(registros, start=2):
+                if u.get('username') != '':
+                    self.usuarios[str(u.get('username'))] = u
+                    self.filas[str(u.get('username'))] = fila
+            self.cargado_en = time.monotonic()
 
-        .form-badge-individual {
-            background: rgba(79, 139, 255, 0.12);
-            border: 1px solid rgba(79, 139, 255, 0.3);
-            color: #4F8BFF;
-            font-size: 10px;
-            letter-spacing: 2px;
-            text-transform: uppercase;
-            padding: 4px 10px;
-            border-radius: 2px;
-            font-family: 'DM Sans', sans-serif;
-        }
+    def obtener(self, username):
+        with self.lock:
+            usuario = self.usuarios.get(str(username))
+            return dict(usuario) if usuario else None
 
-        .form-badge-colectivo {
-            background: rgba(74, 222, 128, 0.1);
-            border: 1px solid rgba(74, 222, 128, 0.3);
-            color: #4ADE80;
-            font-size: 10px;
-            letter-spacing: 2px;
-            text-transform: uppercase;
-            padding: 4px 10px;
-            border-radius: 2px;
-            font-family: 'DM Sans', sans-serif;
-        }
+    def listar(self):
+        with self.lock:
+            return [dict(u) for u in self.usuarios.values()]
 
-        /* Botón volver */
-        .stButton > button[kind="secondary"] {
-            background: transparent !important;
-            border: 1px solid #333 !important;
-            color: #666 !important;
-        }
-    </style>
-    """, unsafe_allow_html=True)
+    def fila(self, username):
+        with self.lock:
+            return self.filas.get(str(username))
 
+    def guardar(self, usuario, fila):
+        with self.lock:
+            self.usuarios[str(usuario['username'])] = dict(usuario)
+            self.filas[str(usuario['username'])] = fila
 
-# ============================================================================
-# GOOGLE SHEETS - USUARIOS
-# ============================================================================
+    def actualizar(self, username, **campos):
+        with self.lock:
+            if str(username) in self.usuarios:
+                self.usuarios[str(username)].update(campos)
 
-def conectar_sheet_usuarios():
-    try:
-        credentials_dict = st.secrets["gcp_service_account"]
-        scopes = [
-            "https://www.googleapis.com/auth/spreadsheets",
-            "https://www.googleapis.com/auth/drive"
-        ]
-        credentials = Credentials.from_service_account_info(credentials_dict, scopes=scopes)
-        client = gspread.authorize(credentials)
-        sheet_name = st.secrets.get("sheet_usuarios", "ISMR_Usuarios")
+    def invalidar(self):
+        with self.lock:
+            self.cargado_en = None
+
+
+@st.cache_resource(show_spinner=False)
+def directorio_usuarios():
+    return DirectorioUsuarios()
 
-        try:
-            spreadsheet = client.open(sheet_name)
-        except:
-            spreadsheet = client.create(sheet_name)
-            spreadsheet.share(credentials_dict["client_email"], perm_type='user', role='writer')
-
-        worksheet = spreadsheet.sheet1
-        headers = ["username", "password_hash", "nombre_completo", "es_admin", "debe_cambiar_password"]
-        current_headers = worksheet.row_values(1)
-        if not current_headers:
-            worksheet.append_row(headers)
-        return worksheet
-    except Exception as e:
-        st.error(f"Error al conectar sheet de usuarios: {str(e)}")
-        return None
+
+def cargar_directorio():
+    """
+    Devuelve el directorio de usuarios, recargándolo desde Sheets solo si
+    venció el TTL. Los errores de Sheets se propagan.
+    """
+    directorio = directorio_usuarios()
+    ttl = st.secrets.get("ttl_usuarios", TTL_DIRECTORIO_USUARIOS)
+    contar_cache("usuarios", directorio.vigente(ttl))
+    if directorio.vigente(ttl):
+        return directorio
+    with directorio.lock:
+        if not directorio.vigente(ttl):
+            worksheet = conectar_sheet_usuarios()
+            directorio.cargar(llamar_sheets(worksheet.get_all_records))
+    return directorio
 
 def obtener_usuario(username):
-    worksheet = conectar_sheet_usuarios()
-    if not worksheet:
-        return None
-    try:
-        datos = worksheet.get_all_records()
-        for usuario in datos:
-            if usuario.get('username') == username:
-                return usuario
-        return None
-    except:
+    """
+    Usuario por username, o None si no existe. Los errores de Sheets se
+    propagan: un fallo de cuota no debe leerse como usuario inexistente.
+    """
+    return cargar_directorio().obtener(username)
+
+def fila_agregada(respuesta):
+    """Número de fila donde quedó un append_row, según la respuesta de la API."""
+    rango = (respuesta or {}).get("updates", {}).get("updatedRange")
+    if not rango:
         return None
+    return gspread.utils.a1_range_to_grid_range(rango.split("!")[-1])["startRowIndex"] + 1
+
+
+def escribir_campos_usuarios(worksheet, cambios):
+    """
+    Escribe {fila: {campo: valor}} en una sola llamada batch_update: o se
+    aplican todos los campos o ninguno.
+    """
+    datos = [
+        {
+            "range": gspread.utils.rowcol_to_a1(fila, ENCABEZADOS_USUARIOS.index(campo) + 1),
+            "values": [[valor]],
+        }
+        for fila, campos in cambios.items()
+        for campo, valor in campos.items()
+    ]
+    llamar_sheets(worksheet.batch_update, datos)
+
 
 def actualizar_password(username, nuevo_password_hash, debe_cambiar=False):
-    worksheet = conectar_sheet_usuarios()
-    if not worksheet:
-        return False
+    """
+    Cambia hash y bandera de un usuario con una sola escritura y ninguna
+    lectura: la fila sale del índice del directorio.
+    """
     try:
-        datos = worksheet.get_all_values()
-        for idx, fila in enumerate(datos[1:], start=2):
-            if fila[0] == username:
-                worksheet.update_cell(idx, 2, nuevo_password_hash)
-                worksheet.update_cell(idx, 5, str(debe_cambiar).upper())
-                return True
-        return False
+        worksheet = conectar_sheet_usuarios()
+        directorio = cargar_directorio()
+        with directorio.lock:
+            fila = directorio.fila(username)
+            if fila is None:
+                return False
+            campos = {
+                "password_hash": nuevo_password_hash,
+                "debe_cambiar_password": str(debe_cambiar).upper(),
+            }
+            escribir_campos_usuarios(worksheet, {fila: campos})
+            directorio.actualizar(username, **campos)
+        return True
     except Exception as e:
         st.error(f"Error al actualizar contraseña: {str(e)}")
         return False
 
 def crear_usuario(username, password_hash, nombre_completo, es_admin=False, debe_cambiar=True):
-    worksheet = conectar_sheet_usuarios()
-    if not worksheet:
-        return False
     try:
-        if obtener_usuario(username):
-            return False
-        nueva_fila = [username, password_hash, nombre_completo,
-                      str(es_admin).upper(), str(debe_cambiar).upper()]
-        worksheet.append_row(nueva_fila)
+        worksheet = conectar_sheet_usuarios()
+        directorio = cargar_directorio()
+        # El lock evita que dos admins creen el mismo username a la vez
+        with directorio.lock:
+            if directorio.obtener(username):
+                return False
+            nueva_fila = [username, password_hash, nombre_completo,
+                          str(es_admin).upper(), str(debe_cambiar).upper()]
+            respuesta = llamar_sheets(worksheet.append_row, nueva_fila)
+            fila = fila_agregada(respuesta)
+            if fila is None:
+                # Sin la fila no se le puede escribir después: que se relea
+                directorio.invalidar()
+            directorio.guardar(dict(zip(ENCABEZADOS_USUARIOS, nueva_fila)), fila)
         return True
     except Exception as e:
         st.error(f"Error al crear usuario: {str(e)}")
         return False
 
-def listar_usuarios():
+def crear_usuarios(nuevos):
+    """
+    Crea varios usuarios con un solo append_rows. `nuevos` es una lista de
+    dicts con las claves de ENCABEZADOS_USUARIOS. Los que ya existen en el
+    directorio se omiten. Devuelve (creados, omitidos) como listas de
+    usernames; el error de Sheets se propaga.
+    """
     worksheet = conectar_sheet_usuarios()
-    if not worksheet:
-        return []
+    directorio = cargar_directorio()
+    with directorio.lock:
+        omitidos = [u["username"] for u in nuevos if directorio.obtener(u["username"])]
+        nuevos = [u for u in nuevos if u["username"] not in omitidos]
+        if not nuevos:
+            return [], omitidos
+        filas = [[u[campo] for campo in ENCABEZADOS_USUARIOS] for u in nuevos]
+        respuesta = llamar_sheets(worksheet.append_rows, filas)
+        desde = fila_agregada(respuesta)
+        if desde is None:
+            directorio.invalidar()
+        for i, fila in enumerate(filas):
+            directorio.guardar(dict(zip(ENCABEZADOS_USUARIOS, fila)), desde + i if desde else None)
+    return [u["username"] for u in nuevos], omitidos
+
+
+def forzar_cambio_password(usernames, password_hash=None):
+    """
+    Marca a varios usuarios para cambiar la contraseña en su próximo
+    acceso (y opcionalmente les asigna una temporal) con un solo
+    batch_update. Devuelve los usernames actualizados.
+    """
+    worksheet = conectar_sheet_usuarios()
+    directorio = cargar_directorio()
+    campos = {"debe_cambiar_password": "TRUE"}
+    if password_hash:
+        campos["password_hash"] = password_hash
+    with directorio.lock:
+        filas = {u: directorio.fila(u) for u in usernames}
+        filas = {u: fila for u, fila in filas.items() if fila is not None}
+        if filas:
+            escribir_campos_usuarios(worksheet, {fila: campos for fila in filas.values()})
+            for username in filas:
+                directorio.actualizar(username, **campos)
+    return list(filas)
+
+def listar_usuarios():
     try:
-        return worksheet.get_all_records()
-    except:
+        return cargar_directorio().listar()
+    except Exception as e:
+        st.error(f"Error al listar usuarios: {str(e)}")
         return []
 
 # ============================================================================
 # GOOGLE SHEETS - CASOS (Individual y Colectivo)
 # ============================================================================
 
+ENCABEZADOS_CASOS = [
+    "Timestamp", "OT-TE", "Edad", "Sexo",
+    "Departamento", "Municipio", "Solicitante",
+    "Nivel de Riesgo", "Observaciones", "Analista", "Usuario Analista"
+]
+
+
+TABS_CASOS = {"individual": "Individual", "colectivo": "Colectivo"}
+
+# Valores permitidos en el formulario y en la carga masiva
+OPCIONES_SEXO = ["Hombre", "Mujer", "Otro", "No Reporta"]
+OPCIONES_SOLICITANTE = ["ARN", "SESP", "OTRO"]
+OPCIONES_NIVEL_RIESGO = ["EXTRAORDINARIO", "EXTREMO", "ORDINARIO"]
+EDAD_MAXIMA = 120
+
+# Partición de los casos por periodo: "" (todo en la pestaña del tipo),
+# "anual" (Individual_2026) o "trimestral" (Individual_2026T4)
+PARTICION_CASOS = ""
+# Pestaña del spreadsheet de casos que lista las particiones creadas
+PESTANA_MANIFIESTO = "Particiones"
+ENCABEZADOS_MANIFIESTO = ["tipo", "periodo", "libro", "pestana", "orden", "creada_en"]
+# Segundos que el manifiesto en memoria se considera vigente
+TTL_MANIFIESTO = 600
+# Separación entre los números de fila de una partición y la siguiente en
+# la réplica: la fila f de la partición de orden o es o * FILAS_POR_PARTICION + f
+FILAS_POR_PARTICION = 10_000_000
+
+
+def periodo_caso(timestamp=None):
+    """Periodo de la partición de un caso según su Timestamp (ahora si es None)."""
+    esquema = st.secrets.get("particion_casos", PARTICION_CASOS)
+    if not esquema:
+        return ""
+    try:
+        fecha = datetime.strptime(str(timestamp), FORMATO_TIMESTAMP) if timestamp else datetime.now()
+    except ValueError:
+        fecha = datetime.now()
+    if esquema == "trimestral":
+        return f"{fecha.year}T{(fecha.month - 1) // 3 + 1}"
+    return str(fecha.year)
+
+
+def base_particion(particion):
+    """Número de fila de la réplica que corresponde a la fila 0 de la partición."""
+    return particion["orden"] * FILAS_POR_PARTICION
+
+
+class ManifiestoParticiones:
+    """
+    Particiones de casos de cada tipo, por orden de creación. La pestaña
+    original del tipo (TABS_CASOS) es siempre la partición 0, de periodo
+    ""; las demás se anotan en la pestaña PESTANA_MANIFIESTO. Si dos
+    instancias crearon a la vez la misma partición, vale la de menor orden.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.particiones = {}
+        self.cargado_en = None
+
+    def vigente(self, ttl):
+        return self.cargado_en is not None and time.monotonic() - self.cargado_en < ttl
+
+    def cargar(self, registros, libro):
+        """`registros` de get_all_records de la pestaña del manifiesto."""
+        with self.lock:
+            self.particiones = {
+                tipo: [{"tipo": tipo, "periodo": "", "libro": libro, "pestana": pestana, "orden": 0}]
+                for tipo, pestana in TABS_CASOS.items()
+            }
+            for r in sorted(registros, key=lambda r: int(r.get("orden") or 0)):
+                tipo, periodo = str(r.get("tipo")), str(r.get("periodo"))
+                if tipo not in self.particiones or not periodo or self._buscar(tipo, periodo):
+                    continue
+                self.particiones[tipo].append({
+                    "tipo": tipo, "periodo": periodo, "libro": str(r.get("libro")),
+                    "pestana": str(r.get("pestana")), "orden": int(r.get("orden")),
+                })
+            self.cargado_en = time.monotonic()
+
+    def _buscar(self, tipo, periodo):
+        return next((p for p in self.particiones.get(tipo, []) if p["periodo"] == periodo), None)
+
+    def buscar(self, tipo, periodo):
+        with self.lock:
+            return self._buscar(tipo, periodo)
+
+    def de_tipo(self, tipo):
+        with self.lock:
+            return list(self.particiones.get(tipo, []))
+
+    def agregar(self, particion):
+        with self.lock:
+            self.particiones[particion["tipo"]].append(particion)
+
+    def invalidar(self):
+        with self.lock:
+            self.cargado_en = None
+
+
+@st.cache_resource(show_spinner=False)
+def manifiesto_particiones():
+    return ManifiestoParticiones()
+
+
+def _leer_manifiesto(manifiesto):
+    libro = st.secrets.get("sheet_name", "ISMR_Casos")
+    if not st.secrets.get("particion_casos", PARTICION_CASOS):
+        # Sin partición por periodo solo existen las pestañas de TABS_CASOS:
+        # no hay nada que leer en Sheets
+        manifiesto.cargar([], libro)
+        return
+    spreadsheet = llamar_sheets(pool_sheets().abrir, libro)
+    try:
+        # Sin particiones la pestaña no existe: no se crea solo para leerla
+        worksheet = llamar_sheets(spreadsheet.worksheet, PESTANA_MANIFIESTO)
+        registros = llamar_sheets(worksheet.get_all_records)
+    except gspread.exceptions.WorksheetNotFound:
+        registros = []
+    manifiesto.cargar(registros, libro)
+
+
+def cargar_manifiesto():
+    """Manifiesto de particiones, releído de Sheets solo si venció el TTL."""
+    manifiesto = manifiesto_particiones()
+    ttl = st.secrets.get("ttl_manifiesto", TTL_MANIFIESTO)
+    contar_cache("manifiesto", manifiesto.vigente(ttl))
+    if not manifiesto.vigente(ttl):
+        with manifiesto.lock:
+            if not manifiesto.vigente(ttl):
+                _leer_manifiesto(manifiesto)
+    return manifiesto
+
+
+def worksheet_particion(particion):
+    """Handle de la pestaña de una partición, con el esquema ya verificado."""
+    pool = pool_sheets()
+    # Buscar o crear la pestaña (una sola vez por proceso). Solo los libros
+    # por periodo se crean; si falta el principal (nombre mal escrito o sin
+    # compartir con la cuenta de servicio) es un error, no un libro nuevo
+    propio = particion["libro"] != st.secrets.get("sheet_name", "ISMR_Casos")
+    worksheet = llamar_sheets(pool.worksheet, particion["libro"], particion["pestana"], crear_si_falta=propio)
+    pool.verificar_esquema(worksheet, ENCABEZADOS_CASOS, reescribir=True)
+    return worksheet
+
+
+def particion_casos(tipo, periodo):
+    """
+    Partición del tipo para `periodo`. Si no existe crea su pestaña (en un
+    spreadsheet propio del periodo si `libro_por_periodo` está activo) y
+    la anota en el manifiesto, releído antes por si otra instancia ya la creó.
+    """
+    manifiesto = cargar_manifiesto()
+    particion = manifiesto.buscar(tipo, periodo)
+    if particion is not None:
+        return particion
+    with manifiesto.lock:
+        _leer_manifiesto(manifiesto)
+        particion = manifiesto.buscar(tipo, periodo)
+        if particion is not None:
+            return particion
+        libro = st.secrets.get("sheet_name", "ISMR_Casos")
+        particion = {
+            "tipo": tipo,
+            "periodo": periodo,
+            "libro": f"{libro}_{periodo}" if st.secrets.get("libro_por_periodo", False) else libro,
+            "pestana": f"{TABS_CASOS[tipo]}_{periodo}",
+            "orden": max(p["orden"] for p in manifiesto.de_tipo(tipo)) + 1,
+        }
+        worksheet_particion(particion)
+        pool = pool_sheets()
+        hoja = llamar_sheets(pool.worksheet, libro, PESTANA_MANIFIESTO)
+        pool.verificar_esquema(hoja, ENCABEZADOS_MANIFIESTO)
+        llamar_sheets(hoja.append_row, [particion[c] for c in ENCABEZADOS_MANIFIESTO[:-1]]
+                      + [datetime.now().strftime(FORMATO_TIMESTAMP)])
+        manifiesto.agregar(particion)
+        logger.info("particiones: creada %s en %s", particion["pestana"], particion["libro"])
+        return particion
+
+
+def obtener_worksheet_casos(tipo, periodo=None):
+    """
+    Handle de la pestaña de casos del tipo para `periodo` (el actual por
+    defecto), con el esquema ya verificado.
+    """
+    return worksheet_particion(particion_casos(tipo, periodo_caso() if periodo is None else periodo))
+
+
 def conectar_sheet_casos(tipo="individual"):
     """
-    Conecta a la hoja de casos según el tipo.
-    tipo = "individual" → hoja 'Individual'
-    tipo = "colectivo"  → hoja 'Colectivo'
-    Ambas hojas están en el mismo Google Spreadsheet.
+    Conecta a la hoja de casos del periodo actual según el tipo.
+    tipo = "individual" → hoja 'Individual' (o 'Individual_<periodo>')
+    tipo = "colectivo"  → hoja 'Colectivo' (o 'Colectivo_<periodo>')
     """
     try:
-        credentials_dict = st.secrets["gcp_service_account"]
-        scopes = [
-            "https://www.googleapis.com/auth/spreadsheets",
-            "https://www.googleapis.com/auth/drive"
-        ]
-        credentials = Credentials.from_service_account_info(credentials_dict, scopes=scopes)
-        client = gspread.authorize(credentials)
+        worksheet = obtener_worksheet_casos(tipo)
+        return worksheet, worksheet.spreadsheet.url
+
+    except Exception as e:
+        st.error(f"Error al conectar Google Sheets ({tipo}): {str(e)}")
+        return None, None
+
+# ============================================================================
+# HILOS EN SEGUNDO PLANO
+# ============================================================================
+
+def iniciar_hilo(objetivo, nombre, *args):
+    """
+    Arranca un hilo daemon con el contexto de la sesión actual. Sin ese
+    contexto st.cache_resource no devuelve los recursos del proceso y el
+    hilo terminaría creando su propio pool, directorio, etc.
+    """
+    hilo = threading.Thread(target=objetivo, args=args, name=nombre, daemon=True)
+    add_script_run_ctx(hilo)
+    hilo.start()
+    return hilo
+
+
+# Hilos del pool compartido para llamadas a Sheets independientes entre sí
+HILOS_LLAMADAS = 8
+
+
+@st.cache_resource(show_spinner=False)
+def pool_llamadas():
+    return concurrent.futures.ThreadPoolExecutor(
+        max_workers=st.secrets.get("hilos_llamadas", HILOS_LLAMADAS),
+        thread_name_prefix="ismr-llamada",
+    )
+
+
+def _con_contexto(ctx, accion, funcion, args):
+    # Los hilos del pool se reutilizan: cada tarea lleva el contexto de
+    # quien la encargó, igual que en iniciar_hilo, y suma a su rerun
+    add_script_run_ctx(threading.current_thread(), ctx)
+    _hilo_local.accion = accion
+    try:
+        return funcion(*args)
+    finally:
+        _hilo_local.accion = None
+
 
-        # Mismo spreadsheet para ambos tipos
-        sheet_name = st.secrets.get("sheet_name", "ISMR_Casos")
-        spreadsheet = client.open(sheet_name)
+def en_segundo_plano(funcion, *args):
+    """Encarga `funcion(*args)` al pool sin esperarla; los errores van al log."""
+    futuro = pool_llamadas().submit(_con_contexto, get_script_run_ctx(),
+                                    getattr(_hilo_local, "accion", None), funcion, args)
+    futuro.add_done_callback(
+        lambda f: f.cancelled() or f.exception() is None
+        or logger.warning("tarea %s fallida: %s", funcion.__name__, f.exception())
+    )
+    return futuro
 
-        # Nombre de la pestaña según el tipo
-        tab_name = "Individual" if tipo == "individual" else "Colectivo"
 
-        # Buscar o crear la pestaña
+def en_paralelo(tareas, timeout=None):
+    """
+    Ejecuta a la vez las tareas {clave: (funcion, *args)} y espera a todas
+    hasta `timeout` segundos en total. Devuelve {clave: (resultado, error)}.
+    Las que no terminan a tiempo se cancelan si aún no empezaron (las que
+    ya corren acaban solas, acotadas por TIMEOUT_SHEETS) y vuelven con un
+    TimeoutError, para que la pantalla siga sin ellas.
+    Las tareas no deben dibujar nada: solo el hilo del script usa st.*.
+    """
+    ctx = get_script_run_ctx()
+    accion = getattr(_hilo_local, "accion", None)
+    pool = pool_llamadas()
+    futuros = {
+        clave: pool.submit(_con_contexto, ctx, accion, funcion, args)
+        for clave, (funcion, *args) in tareas.items()
+    }
+    concurrent.futures.wait(futuros.values(), timeout=timeout)
+    resultados = {}
+    for clave, futuro in futuros.items():
+        if not futuro.done():
+            futuro.cancel()
+            logger.warning("tarea %s sin respuesta tras %s s", clave, timeout)
+            resultados[clave] = (None, TimeoutError(f"sin respuesta tras {timeout} s"))
+        elif futuro.exception() is not None:
+            resultados[clave] = (None, futuro.exception())
+        else:
+            resultados[clave] = (futuro.result(), None)
+    return resultados
+
+# ============================================================================
+# BITÁCORA LOCAL DE CASOS (escritura diferida)
+# ============================================================================
+
+# Segundos máximos entre envíos de la bitácora a Sheets
+INTERVALO_ENVIO_BITACORA = 10
+# Espera tras el primer caso para agrupar ráfagas en un mismo lote
+VENTANA_AGRUPACION_BITACORA = 1.0
+# Filas por llamada a append_rows
+TAMANO_LOTE_BITACORA = 500
+# Días que se conservan los casos ya enviados
+DIAS_RETENCION_BITACORA = 7
+# Rechazos de Sheets por datos inválidos tras los que un caso se aparta de la cola
+MAX_INTENTOS_BITACORA = 5
+
+
+class BitacoraCasos:
+    """
+    Cola durable (SQLite en modo WAL) de casos pendientes de escribir en
+    Sheets. El formulario confirma al analista en cuanto el caso queda
+    aquí; un hilo en segundo plano los envía por lotes.
+    """
+
+    def __init__(self, ruta):
+        self.lock = threading.Lock()
+        self.despertar = threading.Event()
+        # Tipos cuyos pendientes ya se cotejaron contra la hoja tras arrancar
+        self.recuperados = set()
+        self.conexion = sqlite3.connect(ruta, check_same_thread=False, isolation_level=None)
+        self.conexion.execute("PRAGMA journal_mode=WAL")
+        self.conexion.execute("PRAGMA synchronous=FULL")
+        self.conexion.execute("""
+            CREATE TABLE IF NOT EXISTS casos_pendientes (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                tipo TEXT NOT NULL,
+                ot_te TEXT NOT NULL,
+                fila TEXT NOT NULL,
+                creado_en REAL NOT NULL,
+                enviado_en REAL,
+                intentos INTEGER NOT NULL DEFAULT 0,
+                ultimo_error TEXT,
+                apartado_en REAL
+            )
+        """)
+        columnas = {fila[1] for fila in self.conexion.execute("PRAGMA table_info(casos_pendientes)")}
+        if "apartado_en" not in columnas:
+            self.conexion.execute("ALTER TABLE casos_pendientes ADD COLUMN apartado_en REAL")
+        self.conexion.execute(
+            "CREATE INDEX IF NOT EXISTS idx_casos_pendientes ON casos_pendientes (enviado_en, tipo, id)"
+        )
+
+    def encolar(self, tipo, ot_te, fila):
+        self.encolar_varios(tipo, [(ot_te, fila)])
+
+    def encolar_varios(self, tipo, casos):
+        """Encola [(ot_te, fila), ...] en una sola transacción: o entran todos o ninguno."""
+        ahora = time.time()
+        with self.lock:
+            with self.conexion:
+                self.conexion.execute("BEGIN")
+                self.conexion.executemany(
+                    "INSERT INTO casos_pendientes (tipo, ot_te, fila, creado_en) VALUES (?, ?, ?, ?)",
+                    [(tipo, ot_te, json.dumps(fila, ensure_ascii=False), ahora) for ot_te, fila in casos]
+                )
+        self.despertar.set()
+
+    def pendientes(self, tipo, limite=TAMANO_LOTE_BITACORA):
+        with self.lock:
+            filas = self.conexion.execute(
+                "SELECT id, ot_te, fila FROM casos_pendientes "
+                "WHERE enviado_en IS NULL AND apartado_en IS NULL AND tipo = ? ORDER BY id LIMIT ?",
+                (tipo, limite)
+            ).fetchall()
+        return [(id_, ot_te, json.loads(fila)) for id_, ot_te, fila in filas]
+
+    def ot_te_pendientes(self, tipo):
+        # Incluye los apartados: siguen reservando su OT-TE hasta que se descarten
+        with self.lock:
+            filas = self.conexion.execute(
+                "SELECT ot_te FROM casos_pendientes WHERE enviado_en IS NULL AND tipo = ?", (tipo,)
+            ).fetchall()
+        return {ot_te for (ot_te,) in filas}
+
+    def contar_pendientes(self):
+        with self.lock:
+            filas = self.conexion.execute(
+                "SELECT tipo, COUNT(*) FROM casos_pendientes "
+                "WHERE enviado_en IS NULL AND apartado_en IS NULL GROUP BY tipo"
+            ).fetchall()
+        return dict(filas)
+
+    def marcar_enviados(self, ids):
+        with self.lock:
+            self.conexion.executemany(
+                "UPDATE casos_pendientes SET enviado_en = ? WHERE id = ?",
+                [(time.time(), id_) for id_ in ids]
+            )
+
+    def marcar_error(self, ids, error, apartar=False):
+        """
+        Suma un intento fallido. Con apartar=True (Sheets rechazó los datos
+        del caso) el caso sale de la cola al llegar a MAX_INTENTOS_BITACORA.
+        """
+        limite = MAX_INTENTOS_BITACORA if apartar else None
+        with self.lock:
+            self.conexion.executemany(
+                "UPDATE casos_pendientes SET intentos = intentos + 1, ultimo_error = ?, "
+                "apartado_en = CASE WHEN intentos + 1 >= ? THEN ? END WHERE id = ?",
+                [(error, limite, time.time(), id_) for id_ in ids]
+            )
+
+    def apartados(self):
+        with self.lock:
+            return self.conexion.execute(
+                "SELECT id, tipo, ot_te, intentos, ultimo_error, apartado_en FROM casos_pendientes "
+                "WHERE enviado_en IS NULL AND apartado_en IS NOT NULL ORDER BY id"
+            ).fetchall()
+
+    def reencolar(self, ids):
+        with self.lock:
+            self.conexion.executemany(
+                "UPDATE casos_pendientes SET apartado_en = NULL, intentos = 0 WHERE id = ?",
+                [(id_,) for id_ in ids]
+            )
+        self.despertar.set()
+
+    def descartar(self, ids):
+        """Borra casos apartados; devuelve {tipo: OT-TEs} para liberarlas del índice."""
+        liberados = defaultdict(list)
+        with self.lock:
+            with self.conexion:
+                self.conexion.execute("BEGIN")
+                for id_ in ids:
+                    fila = self.conexion.execute(
+                        "DELETE FROM casos_pendientes WHERE id = ? AND apartado_en IS NOT NULL "
+                        "RETURNING tipo, ot_te", (id_,)
+                    ).fetchone()
+                    if fila:
+                        liberados[fila[0]].append(fila[1])
+        return liberados
+
+    def purgar_enviados(self):
+        limite = time.time() - DIAS_RETENCION_BITACORA * 86400
+        with self.lock:
+            self.conexion.execute(
+                "DELETE FROM casos_pendientes WHERE enviado_en IS NOT NULL AND enviado_en < ?", (limite,)
+            )
+
+
+def enviar_bitacora(bitacora):
+    """
+    Escribe en Sheets los casos pendientes de cada tipo con append_rows,
+    en la partición que les toca. La primera vez tras arrancar, y tras cada
+    envío fallido, coteja los pendientes contra la columna OT-TE, por si
+    las filas se escribieron sin que se llegara a marcarlas (el proceso
+    murió o la respuesta de Sheets no llegó).
+    """
+    for tipo in TABS_CASOS:
+        lote = bitacora.pendientes(tipo)
+        if not lote:
+            continue
+
+        if tipo not in bitacora.recuperados:
+            replica = replica_casos()
+            sincronizar_replica(replica, [tipo])
+            escritos = replica.ot_te(tipo)
+            bitacora.marcar_enviados([id_ for id_, ot_te, _ in lote if ot_te in escritos])
+            bitacora.recuperados.add(tipo)
+            lote = bitacora.pendientes(tipo)
+
+        while lote:
+            # Cada caso va a la partición del periodo de su Timestamp
+            por_periodo = {}
+            for id_, _, fila in lote:
+                por_periodo.setdefault(periodo_caso(fila[0]), []).append((id_, fila))
+            rechazados = False
+            for periodo, casos in por_periodo.items():
+                particion = particion_casos(tipo, periodo)
+                worksheet = worksheet_particion(particion)
+                ids = [id_ for id_, _ in casos]
+                try:
+                    llamar_sheets(worksheet.append_rows, [fila for _, fila in casos])
+                except Exception as e:
+                    if not datos_rechazados(e):
+                        _envio_fallido(bitacora, particion, ids, e)
+                        raise
+                    ids = _enviar_de_a_uno(bitacora, particion, worksheet, casos)
+                    rechazados = True
+                else:
+                    bitacora.marcar_enviados(ids)
+                if ids:
+                    replica_casos().marcar_escrita(particion)
+                    logger.info("bitácora: %d casos %s enviados a Sheets", len(ids), particion["pestana"])
+            if rechazados:
+                # Los rechazados se reintentan en el próximo envío, no en este
+                break
+            lote = bitacora.pendientes(tipo)
+        # Que el panel de admin vea los casos nuevos sin esperar al intervalo
+        replica_casos().despertar.set()
+    bitacora.purgar_enviados()
+
+
+def datos_rechazados(error):
+    """Sheets rechazó el contenido de las filas (400): reintentar no lo arregla."""
+    return isinstance(error, gspread.exceptions.APIError) and error.response.status_code == 400
+
+
+def _envio_fallido(bitacora, particion, ids, error):
+    """
+    El envío pudo haberse aplicado aunque falló (timeout tras escribir): el
+    próximo relee la partición y coteja antes de volver a enviar.
+    """
+    bitacora.marcar_error(ids, str(error))
+    bitacora.recuperados.discard(particion["tipo"])
+    replica_casos().marcar_escrita(particion)
+
+
+def _enviar_de_a_uno(bitacora, particion, worksheet, casos):
+    """
+    Tras un rechazo del lote completo, envía sus casos de a uno para que
+    solo los culpables sumen intentos (y terminen apartados). Devuelve los
+    ids enviados, ya marcados en la bitácora.
+    """
+    enviados = []
+    for id_, fila in casos:
+        try:
+            llamar_sheets(worksheet.append_rows, [fila])
+        except Exception as e:
+            if not datos_rechazados(e):
+                _envio_fallido(bitacora, particion, [id_], e)
+                raise
+            bitacora.marcar_error([id_], str(e), apartar=True)
+            logger.warning("bitácora: Sheets rechazó el caso %s: %s", fila[1], e)
+            continue
+        bitacora.marcar_enviados([id_])
+        enviados.append(id_)
+    return enviados
+
+
+def _bucle_envio_bitacora(bitacora):
+    while True:
+        if bitacora.despertar.wait(INTERVALO_ENVIO_BITACORA):
+            time.sleep(VENTANA_AGRUPACION_BITACORA)
+        bitacora.despertar.clear()
         try:
-            worksheet = spreadsheet.worksheet(tab_name)
-        except:
-            worksheet = spreadsheet.add_worksheet(title=tab_name, rows="1000", cols="20")
-
-        # Encabezados
-        headers = [
-            "Timestamp", "OT-TE", "Edad", "Sexo",
-            "Departamento", "Municipio", "Solicitante",
-            "Nivel de Riesgo", "Observaciones", "Analista", "Usuario Analista"
+            enviar_bitacora(bitacora)
+        except Exception:
+            logger.exception("bitácora: envío fallido, se reintentará")
+
+
+@st.cache_resource(show_spinner=False)
+def bitacora_casos():
+    bitacora = BitacoraCasos(st.secrets.get("ruta_bitacora", "ismr_bitacora.db"))
+    iniciar_hilo(_bucle_envio_bitacora, "ismr-bitacora", bitacora)
+    if bitacora.contar_pendientes():
+        # Casos que quedaron de antes de reiniciar: se reenvían de inmediato
+        bitacora.despertar.set()
+    return bitacora
+
+# ============================================================================
+# RÉPLICA LOCAL DE CASOS (SQLite)
+# ============================================================================
+
+# Segundos entre sincronizaciones de la réplica con Sheets
+INTERVALO_SYNC_REPLICA = 60
+# Segundos tras los cuales se recarga la pestaña completa aunque no se detecten cambios
+RECARGA_COMPLETA_CADA = 3600
+# Filas del inicio y del final de lo ya sincronizado que se cotejan en cada lectura
+MUESTRA_CONTROL = 20
+
+# Columnas SQL de la réplica, en el mismo orden que ENCABEZADOS_CASOS
+COLUMNAS_REPLICA = [
+    "timestamp", "ot_te", "edad", "sexo",
+    "departamento", "municipio", "solicitante",
+    "nivel_riesgo", "observaciones", "analista", "usuario_analista"
+]
+COLUMNA_REPLICA = dict(zip(ENCABEZADOS_CASOS, COLUMNAS_REPLICA))
+# Letra de la última columna de casos ("K"); vale mientras haya 26 columnas o menos
+ULTIMA_COLUMNA_CASOS = chr(ord("A") + len(ENCABEZADOS_CASOS) - 1)
+
+
+class ReplicaCasos:
+    """
+    Copia local en SQLite de las pestañas de casos. El panel de admin
+    consulta aquí (métricas, filtros, tabla, exportación) y un hilo la
+    mantiene al día con Sheets cada INTERVALO_SYNC_REPLICA segundos.
+    Cada partición ocupa su propio rango de números de fila
+    (base_particion), así el tipo completo se sigue leyendo en orden.
+    """
+
+    def __init__(self, ruta):
+        self.lock = threading.Lock()
+        self.despertar = threading.Event()
+        # (tipo, orden) → cuándo la bitácora escribió por última vez en esa partición
+        self.escritas = {}
+        # Una sincronización a la vez por tipo (hilo de fondo y botón del panel)
+        self.locks_sync = {tipo: threading.RLock() for tipo in TABS_CASOS}
+        self.conexion = sqlite3.connect(ruta, check_same_thread=False, isolation_level=None)
+        self.conexion.execute("PRAGMA journal_mode=WAL")
+        columnas = ", ".join(f"{c} {'INTEGER' if c == 'edad' else 'TEXT'}" for c in COLUMNAS_REPLICA)
+        self.conexion.execute(f"""
+            CREATE TABLE IF NOT EXISTS casos (
+                tipo TEXT NOT NULL,
+                fila INTEGER NOT NULL,
+                {columnas},
+                PRIMARY KEY (tipo, fila)
+            )
+        """)
+        # Los filtros del panel se resuelven con IndiceFiltros, no con índices SQL
+        for columna in ["departamento", "nivel_riesgo", "analista"]:
+            self.conexion.execute(f"DROP INDEX IF EXISTS idx_casos_{columna}")
+        # El estado de sincronización es por partición; sin él, la primera
+        # sincronización recarga cada partición completa
+        self.conexion.execute("DROP TABLE IF EXISTS sync_replica")
+        self.conexion.execute("""
+            CREATE TABLE IF NOT EXISTS sync_particiones (
+                tipo TEXT NOT NULL,
+                orden INTEGER NOT NULL,
+                filas INTEGER NOT NULL,
+                sincronizado_en REAL NOT NULL,
+                huella TEXT NOT NULL,
+                recargado_en REAL NOT NULL,
+                PRIMARY KEY (tipo, orden)
+            )
+        """)
+
+    def _registros(self, tipo, filas, desde):
+        n = len(COLUMNAS_REPLICA)
+        return [
+            (tipo, idx, *(list(fila[:n]) + [""] * (n - len(fila))))
+            for idx, fila in enumerate(filas, start=desde)
         ]
 
-        current_headers = worksheet.row_values(1)
-        if not current_headers:
-            worksheet.append_row(headers)
-        elif current_headers != headers:
-            worksheet.update('A1', [headers])
+    def _escribir(self, particion, registros, borrar, filas, huella, recargado_en):
+        tipo, base = particion["tipo"], base_particion(particion)
+        marcadores = ", ".join(["?"] * (len(COLUMNAS_REPLICA) + 2))
+        with self.lock:
+            self.conexion.execute("BEGIN")
+            try:
+                if borrar:
+                    self.conexion.execute(
+                        "DELETE FROM casos WHERE tipo = ? AND fila >= ? AND fila < ?",
+                        (tipo, base, base + FILAS_POR_PARTICION)
+                    )
+                self.conexion.executemany(
+                    f"INSERT OR REPLACE INTO casos (tipo, fila, {', '.join(COLUMNAS_REPLICA)}) "
+                    f"VALUES ({marcadores})",
+                    registros
+                )
+                self.conexion.execute(
+                    "INSERT OR REPLACE INTO sync_particiones "
+                    "(tipo, orden, filas, sincronizado_en, huella, recargado_en) VALUES (?, ?, ?, ?, ?, ?)",
+                    (tipo, particion["orden"], filas, time.time(), huella, recargado_en)
+                )
+                self.conexion.execute("COMMIT")
+            except Exception:
+                self.conexion.execute("ROLLBACK")
+                raise
+
+    def reemplazar(self, particion, filas, huella):
+        """Sustituye todas las filas de la partición (fila 2 de la hoja en adelante)."""
+        registros = self._registros(particion["tipo"], filas, base_particion(particion) + 2)
+        self._escribir(particion, registros, True, len(filas), huella, time.time())
+
+    def agregar(self, particion, filas, huella):
+        """Añade filas leídas a continuación de las ya sincronizadas."""
+        estado = self.estado(particion)
+        registros = self._registros(particion["tipo"], filas, base_particion(particion) + estado["filas"] + 2)
+        self._escribir(particion, registros, False, estado["filas"] + len(filas), huella,
+                       estado["recargado_en"])
+
+    def estado(self, particion):
+        with self.lock:
+            fila = self.conexion.execute(
+                "SELECT filas, huella, recargado_en, sincronizado_en FROM sync_particiones "
+                "WHERE tipo = ? AND orden = ?",
+                (particion["tipo"], particion["orden"])
+            ).fetchone()
+        return dict(zip(["filas", "huella", "recargado_en", "sincronizado_en"], fila)) if fila else None
+
+    def version(self, tipo):
+        """Identifica el contenido actual del tipo; cambia con cada sincronización que trae datos."""
+        with self.lock:
+            filas = self.conexion.execute(
+                "SELECT orden, filas, huella, recargado_en FROM sync_particiones WHERE tipo = ? ORDER BY orden",
+                (tipo,)
+            ).fetchall()
+        return tuple(filas) or None
+
+    def marcar_sincronizado(self, particion):
+        with self.lock:
+            self.conexion.execute(
+                "UPDATE sync_particiones SET sincronizado_en = ? WHERE tipo = ? AND orden = ?",
+                (time.time(), particion["tipo"], particion["orden"])
+            )
+
+    def sincronizado_en(self, tipo):
+        """Última sincronización con Sheets de alguna partición del tipo (None si nunca)."""
+        with self.lock:
+            fila = self.conexion.execute(
+                "SELECT MAX(sincronizado_en) FROM sync_particiones WHERE tipo = ? AND orden >= 0", (tipo,)
+            ).fetchone()
+        return fila[0]
+
+    def forzar_recarga(self, particion):
+        """La próxima sincronización relee la partición completa."""
+        with self.lock:
+            self.conexion.execute(
+                "UPDATE sync_particiones SET recargado_en = 0 WHERE tipo = ? AND orden = ?",
+                (particion["tipo"], particion["orden"])
+            )
+
+    def marcar_escrita(self, particion):
+        """La bitácora escribió en la partición: la próxima sincronización la lee aunque esté cerrada."""
+        with self.lock:
+            self.escritas[(particion["tipo"], particion["orden"])] = time.time()
+
+    def escrita_en(self, particion):
+        with self.lock:
+            return self.escritas.get((particion["tipo"], particion["orden"]), 0)
+
+    def ot_te(self, tipo):
+        with self.lock:
+            filas = self.conexion.execute("SELECT ot_te FROM casos WHERE tipo = ?", (tipo,)).fetchall()
+        return {str(v).strip() for (v,) in filas if v is not None and str(v).strip()}
+
+    def consultar(self, tipo, filas=None):
+        """
+        Casos del tipo en el orden de la hoja, como grilla de valores en el
+        orden de ENCABEZADOS_CASOS. Con `filas`, solo esos números de fila
+        de la réplica (base de la partición + fila de la hoja).
+        """
+        sql = f"SELECT {', '.join(COLUMNAS_REPLICA)} FROM casos WHERE tipo = ?"
+        parametros = [tipo]
+        if filas is not None:
+            sql += " AND fila IN (SELECT value FROM json_each(?))"
+            parametros.append(json.dumps([int(f) for f in filas]))
+        with self.lock:
+            return self.conexion.execute(sql + " ORDER BY fila", parametros).fetchall()
+
+    def de_particion(self, particion):
+        """Casos de una sola partición, en el orden de la hoja."""
+        base = base_particion(particion)
+        with self.lock:
+            return self.conexion.execute(
+                f"SELECT {', '.join(COLUMNAS_REPLICA)} FROM casos "
+                "WHERE tipo = ? AND fila >= ? AND fila < ? ORDER BY fila",
+                (particion["tipo"], base, base + FILAS_POR_PARTICION)
+            ).fetchall()
+
+    def numeros(self, tipo):
+        """Números de fila de la réplica de los casos del tipo, en el orden de consultar()."""
+        with self.lock:
+            filas = self.conexion.execute(
+                "SELECT fila FROM casos WHERE tipo = ? ORDER BY fila", (tipo,)
+            ).fetchall()
+        return [fila for (fila,) in filas]
+
+    def pagina(self, tipo, filas=None, orden=None, descendente=False, limite=50, desde=0):
+        """
+        Hasta `limite` casos del tipo a partir de la posición `desde`, ordenados
+        por el encabezado `orden` (orden de la hoja si es None). Con `filas`,
+        solo entre esos números de fila. Solo la página sale de SQLite.
+        """
+        if orden is None and filas is not None:
+            # En orden de hoja la página se recorta de los números de fila
+            if descendente:
+                filas = filas[::-1]
+            filas = filas[desde:desde + limite]
+            registros = self.consultar(tipo, filas)
+            return registros[::-1] if descendente else registros
+
+        sentido = "DESC" if descendente else "ASC"
+        columna = COLUMNA_REPLICA[orden] if orden else "fila"
+        sql = f"SELECT {', '.join(COLUMNAS_REPLICA)} FROM casos WHERE tipo = ?"
+        parametros = [tipo]
+        if filas is not None:
+            sql += " AND fila IN (SELECT value FROM json_each(?))"
+            parametros.append(json.dumps([int(f) for f in filas]))
+        sql += f" ORDER BY {columna} {sentido}, fila {sentido} LIMIT ? OFFSET ?"
+        with self.lock:
+            return self.conexion.execute(sql, parametros + [limite, desde]).fetchall()
+
+
+# Columnas de casos con pocos valores distintos que se guardan como categorías
+COLUMNAS_CATEGORICAS_CASOS = ["Sexo", "Solicitante", "Nivel de Riesgo", "Departamento", "Municipio", "Analista"]
+FORMATO_TIMESTAMP = "%Y-%m-%d %H:%M:%S"
+
+
+def construir_dataframe_casos(filas):
+    """
+    Arma el DataFrame de casos columna por columna a partir de la grilla
+    de valores, con tipos compactos: categorías para las columnas de pocos
+    valores, Edad como Int8, Timestamp como datetime y el texto libre en
+    cadenas de Arrow.
+    """
+    n = len(ENCABEZADOS_CASOS)
+    grilla = np.empty((len(filas), n), dtype=object)
+    if any(len(fila) != n for fila in filas):
+        filas = [tuple(fila[:n]) + ("",) * (n - len(fila)) for fila in filas]
+    if filas:
+        grilla[:] = filas
+
+    datos = {}
+    for i, encabezado in enumerate(ENCABEZADOS_CASOS):
+        valores = grilla[:, i]
+        if encabezado in COLUMNAS_CATEGORICAS_CASOS:
+            datos[encabezado] = pd.Categorical(valores)
+        elif encabezado == "Edad":
+            edad = pd.to_numeric(valores, errors="coerce")
+            datos[encabezado] = pd.array(np.where((edad >= 0) & (edad <= 127), edad, np.nan), dtype="Int8")
+        elif encabezado == "Timestamp":
+            datos[encabezado] = pd.to_datetime(valores, format=FORMATO_TIMESTAMP, errors="coerce").values
+        else:
+            datos[encabezado] = pd.array(valores, dtype="string[pyarrow]")
+    return pd.DataFrame(datos, columns=ENCABEZADOS_CASOS)
 
-        return worksheet, spreadsheet.url
 
-    except Exception as e:
-        st.error(f"Error al conectar Google Sheets ({tipo}): {str(e)}")
-        return None, None
+def _huella(filas):
+    n = len(ENCABEZADOS_CASOS)
+    normalizadas = [[str(v) for v in fila[:n]] + [""] * (n - len(fila)) for fila in filas]
+    return hashlib.sha1(json.dumps(normalizadas, ensure_ascii=False).encode()).hexdigest()
+
+
+def _huella_completa(filas):
+    return _huella(filas[:MUESTRA_CONTROL] + filas[-MUESTRA_CONTROL:])
+
+
+def _rangos_cola(filas_conocidas):
+    """
+    Rangos de una lectura incremental: las muestras de control (primeras
+    y últimas filas ya sincronizadas) y todo lo que sigue a la última.
+    """
+    ultima = filas_conocidas + 1
+    n_muestra = min(MUESTRA_CONTROL, filas_conocidas)
+    return [
+        f"A2:{ULTIMA_COLUMNA_CASOS}{n_muestra + 1}",
+        f"A{ultima - n_muestra + 1}:{ULTIMA_COLUMNA_CASOS}{ultima}",
+        f"A{ultima + 1}:{ULTIMA_COLUMNA_CASOS}",
+    ]
+
+
+def _evaluar_cola(cabeza, cola, nuevas, filas_conocidas, huella):
+    """
+    Devuelve (nuevas, huella_actualizada), o None si las muestras no
+    coinciden con lo sincronizado: alguien editó o borró filas y hay que
+    recargar todo.
+    """
+    n_muestra = min(MUESTRA_CONTROL, filas_conocidas)
+    # La API omite las filas vacías al final de cada rango
+    cabeza = cabeza + [[]] * (n_muestra - len(cabeza))
+    cola = cola + [[]] * (n_muestra - len(cola))
+    if _huella(cabeza + cola) != huella:
+        return None
+    cabeza = (cabeza + nuevas)[:MUESTRA_CONTROL]
+    cola = (cola + nuevas)[-MUESTRA_CONTROL:]
+    return nuevas, _huella(cabeza + cola)
+
+
+def _leer_rangos(worksheets, rangos_por_clave):
+    """
+    Lee los rangos de varias pestañas con una sola llamada values_batch_get
+    por spreadsheet y devuelve los valores agrupados por clave.
+    """
+    por_libro = {}
+    for clave, rangos in rangos_por_clave.items():
+        worksheet = worksheets[clave]
+        _, pedidos = por_libro.setdefault(worksheet.spreadsheet.id, (worksheet.spreadsheet, []))
+        pedidos.extend((clave, f"'{worksheet.title}'!{rango}") for rango in rangos)
+    valores = {clave: [] for clave in rangos_por_clave}
+    for spreadsheet, pedidos in por_libro.values():
+        respuesta = llamar_sheets(spreadsheet.values_batch_get, [rango for _, rango in pedidos])
+        for (clave, _), rango in zip(pedidos, respuesta["valueRanges"]):
+            valores[clave].append(rango.get("values", []))
+    return valores
+
+
+def sincronizar_replica(replica, tipos=None):
+    """
+    Sincroniza las particiones de casos de `tipos` (todos por defecto) y
+    carga el archivo local si cambió. Se
+    leen solo las que pueden haber cambiado: la más reciente de cada tipo,
+    las que la bitácora escribió desde la última vez y las que toca
+    recargar; las de periodos cerrados no cuestan nada el resto del tiempo.
+    De cada una se traen solo las filas agregadas desde la última vez, con
+    una llamada a la API por spreadsheet. Una partición se recarga completa
+    la primera vez, cuando se fuerza (forzar_recarga) o cuando las
+    muestras de control revelan ediciones o borrados (esto último cuesta
+    una segunda llamada); las de periodos en curso, además, cada
+    RECARGA_COMPLETA_CADA segundos.
+    """
+    tipos = [t for t in TABS_CASOS if tipos is None or t in tipos]
+    with medir("replica.sincronizar"), contextlib.ExitStack() as pila:
+        # Siempre en el mismo orden, para no bloquearse con otro hilo
+        for tipo in tipos:
+            pila.enter_context(replica.locks_sync[tipo])
+
+        # Tipos cuyas estructuras en memoria hay que reconstruir desde la réplica
+        reconstruir = {tipo for tipo in tipos if sincronizar_archivo(replica, tipo)}
+
+        manifiesto = cargar_manifiesto()
+        ahora = time.time()
+        periodo_actual = periodo_caso()
+        particiones, estados, ultimas, recargar = {}, {}, {}, set()
+        for tipo in tipos:
+            todas = manifiesto.de_tipo(tipo)
+            ultimas[tipo] = todas[-1]["orden"]
+            for particion in todas:
+                clave = (tipo, particion["orden"])
+                estado = replica.estado(particion)
+                # Un periodo terminado no recibe casos nuevos: solo se relee si
+                # la bitácora le escribió o se forzó su recarga, nunca por tiempo
+                cerrada = particion["orden"] != ultimas[tipo] and particion["periodo"] != periodo_actual
+                vencida = estado is not None and (
+                    estado["recargado_en"] == 0 if cerrada
+                    else ahora - estado["recargado_en"] >= RECARGA_COMPLETA_CADA
+                )
+                if (estado is None or vencida or particion["orden"] == ultimas[tipo]
+                        or replica.escrita_en(particion) >= estado["sincronizado_en"]):
+                    particiones[clave] = particion
+                    estados[clave] = estado
+                    if vencida:
+                        recargar.add(clave)
+
+        worksheets = {clave: worksheet_particion(p) for clave, p in particiones.items()}
+        incrementales = [
+            c for c in particiones
+            if estados[c] and estados[c]["filas"] and c not in recargar
+        ]
+        rango_completo = [f"A2:{ULTIMA_COLUMNA_CASOS}"]
+        leidos = _leer_rangos(worksheets, {
+            c: _rangos_cola(estados[c]["filas"]) if c in incrementales else rango_completo
+            for c in particiones
+        })
+
+        completas = {c: leidos[c][0] for c in particiones if c not in incrementales}
+        for clave in incrementales:
+            lectura = _evaluar_cola(*leidos[clave], estados[clave]["filas"], estados[clave]["huella"])
+            if lectura is None:
+                completas[clave] = None
+                continue
+            nuevas, huella = lectura
+            particion = particiones[clave]
+            desde = base_particion(particion) + estados[clave]["filas"] + 2
+            if nuevas:
+                replica.agregar(particion, nuevas, huella)
+                logger.info("réplica: %d casos %s nuevos", len(nuevas), particion["pestana"])
+            else:
+                replica.marcar_sincronizado(particion)
+            if clave[1] == ultimas[clave[0]]:
+                propagar_cambios(replica, clave[0], nuevas, desde, completa=False)
+            elif nuevas:
+                # Filas tardías en una partición anterior: quedan en medio del orden
+                reconstruir.add(clave[0])
+
+        faltantes = [c for c, valores in completas.items() if valores is None]
+        for clave, (valores,) in _leer_rangos(worksheets, {c: rango_completo for c in faltantes}).items():
+            completas[clave] = valores
+
+        for clave, valores in completas.items():
+            particion = particiones[clave]
+            replica.reemplazar(particion, valores, _huella_completa(valores))
+            logger.info("réplica: %d casos %s recargados", len(valores), particion["pestana"])
+            archivo = replica.estado(particion_archivo(clave[0]))
+            if len(manifiesto.de_tipo(clave[0])) == 1 and not (archivo and archivo["filas"]):
+                propagar_cambios(replica, clave[0], valores, base_particion(particion) + 2, completa=True)
+            else:
+                reconstruir.add(clave[0])
+        for tipo in reconstruir:
+            propagar_cambios(replica, tipo, None, None, completa=True)
+
+
+def propagar_cambios(replica, tipo, filas, desde, completa):
+    """
+    Actualiza lo que se mantiene en memoria a partir de una sincronización.
+    `desde` es el número de fila de la réplica de la primera de `filas`.
+    Con `completa` y `filas` None, se reconstruye todo desde la réplica.
+    """
+    indice = indice_ot_te(tipo)
+    resumen = resumen_casos(tipo)
+    filtros = indice_filtros(tipo)
+    if completa:
+        if filas is None:
+            filas, numeros = replica.consultar(tipo), replica.numeros(tipo)
+        else:
+            numeros = range(desde, desde + len(filas))
+        indice.cargar(replica.ot_te(tipo) | bitacora_casos().ot_te_pendientes(tipo))
+        resumen.reconstruir(filas)
+        filtros.reconstruir(filas, numeros)
+    else:
+        columna = ENCABEZADOS_CASOS.index("OT-TE")
+        indice.agregar(fila[columna] for fila in filas if len(fila) > columna)
+        resumen.agregar(filas)
+        filtros.agregar(filas, desde)
+
+
+def _bucle_sync_replica(replica, intervalo):
+    while True:
+        try:
+            sincronizar_replica(replica)
+        except Exception:
+            logger.exception("réplica: sincronización fallida, se reintentará")
+        replica.despertar.wait(intervalo)
+        replica.despertar.clear()
+
+
+@st.cache_resource(show_spinner=False)
+def replica_casos():
+    replica = ReplicaCasos(st.secrets.get("ruta_replica", "ismr_replica.db"))
+    intervalo = st.secrets.get("intervalo_sync_replica", INTERVALO_SYNC_REPLICA)
+    iniciar_hilo(_bucle_sync_replica, "ismr-replica", replica, intervalo)
+    dias = st.secrets.get("dias_archivo", DIAS_ARCHIVO)
+    if dias:
+        horas = st.secrets.get("intervalo_archivo_horas", INTERVALO_ARCHIVO_HORAS)
+        iniciar_hilo(_bucle_archivo, "ismr-archivo", replica, dias, horas * 3600)
+    return replica
+
+# ============================================================================
+# RESUMEN DE CASOS (métricas del panel)
+# ============================================================================
+
+# Columnas cuyos valores distintos se cuentan para las métricas del panel
+COLUMNAS_RESUMEN = ["Departamento", "Municipio"]
+NIVELES_RIESGO_ALTO = {"EXTREMO", "EXTRAORDINARIO"}
+
+
+class ResumenCasos:
+    """
+    Métricas de una pestaña que se mantienen al sincronizar: total de
+    casos, conteo por valor de COLUMNAS_RESUMEN y casos de riesgo alto.
+    Leerlas no depende del número de casos.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.cargado = False
+        self._vaciar()
+
+    def _vaciar(self):
+        self.total = 0
+        self.riesgo_alto = 0
+        self.conteos = {c: {} for c in COLUMNAS_RESUMEN}
+
+    def _sumar(self, filas):
+        posiciones = {c: ENCABEZADOS_CASOS.index(c) for c in COLUMNAS_RESUMEN}
+        riesgo = ENCABEZADOS_CASOS.index("Nivel de Riesgo")
+        for fila in filas:
+            self.total += 1
+            for columna, i in posiciones.items():
+                valor = str(fila[i]) if i < len(fila) else ""
+                conteo = self.conteos[columna]
+                conteo[valor] = conteo.get(valor, 0) + 1
+            if riesgo < len(fila) and str(fila[riesgo]) in NIVELES_RIESGO_ALTO:
+                self.riesgo_alto += 1
+
+    def reconstruir(self, filas):
+        with self.lock:
+            self._vaciar()
+            self._sumar(filas)
+            self.cargado = True
+
+    def agregar(self, filas):
+        """Suma filas nuevas; no hace nada si el resumen aún no se construyó."""
+        with self.lock:
+            if self.cargado:
+                self._sumar(filas)
+
+    def metricas(self):
+        with self.lock:
+            return (self.total, len(self.conteos["Departamento"]),
+                    len(self.conteos["Municipio"]), self.riesgo_alto)
+
+
+@st.cache_resource(show_spinner=False)
+def resumen_casos(tipo):
+    return ResumenCasos()
+
+
+def cargar_resumen(replica, tipo):
+    """Resumen del tipo; se construye desde la réplica la primera vez."""
+    resumen = resumen_casos(tipo)
+    contar_cache("resumen", resumen.cargado)
+    if not resumen.cargado:
+        with replica.locks_sync[tipo]:
+            if not resumen.cargado:
+                resumen.reconstruir(replica.consultar(tipo))
+    return resumen
+
+# ============================================================================
+# ÍNDICES DE FILTROS (listas de filas por valor)
+# ============================================================================
+
+# Columnas filtrables en el panel. Agregar una columna aquí basta para que
+# tenga su índice y su selectbox.
+COLUMNAS_FILTRO = ["Departamento", "Nivel de Riesgo", "Analista"]
+
+
+class IndiceFiltros:
+    """
+    Para cada columna de COLUMNAS_FILTRO y cada valor, la lista creciente
+    de números de fila de la réplica que lo tienen. Combinar filtros es
+    intersecar listas empezando por la más corta, sin recorrer los casos.
+    Como las filas se agregan en orden cronológico, un rango de fechas
+    se puede resolver igual, como intervalo de números de fila.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.cargado = False
+        self._vaciar()
+
+    def _vaciar(self):
+        self.filas = array("l")
+        self.listas = {c: {} for c in COLUMNAS_FILTRO}
+        self.opciones = {c: [] for c in COLUMNAS_FILTRO}
+
+    def _sumar(self, filas, numeros):
+        posiciones = {c: ENCABEZADOS_CASOS.index(c) for c in COLUMNAS_FILTRO}
+        for numero, fila in zip(numeros, filas):
+            self.filas.append(numero)
+            for columna, i in posiciones.items():
+                valor = str(fila[i]) if i < len(fila) else ""
+                lista = self.listas[columna].get(valor)
+                if lista is None:
+                    lista = self.listas[columna][valor] = array("l")
+                    bisect.insort(self.opciones[columna], valor)
+                lista.append(numero)
+
+    def reconstruir(self, filas, numeros):
+        """`numeros`: número de fila de la réplica de cada una de `filas`, crecientes."""
+        with self.lock:
+            self._vaciar()
+            self._sumar(filas, numeros)
+            self.cargado = True
+
+    def agregar(self, filas, desde):
+        """Indexa filas nuevas; no hace nada si el índice aún no se construyó."""
+        with self.lock:
+            if self.cargado:
+                self._sumar(filas, range(desde, desde + len(filas)))
+
+    def valores(self, columna):
+        with self.lock:
+            return list(self.opciones[columna])
+
+    def filtrar(self, filtros):
+        """Números de fila (ordenados) que cumplen todos los `filtros` {columna: valor}."""
+        with self.lock:
+            if not filtros:
+                return np.array(self.filas, dtype=np.int64)
+            listas = [self.listas[c].get(v) for c, v in filtros.items()]
+            if any(lista is None for lista in listas):
+                return np.empty(0, dtype=np.int64)
+            # Copias: las listas pueden crecer mientras se interseca
+            listas = sorted((np.array(lista, dtype=np.int64) for lista in listas), key=len)
+
+        resultado = listas[0]
+        for otra in listas[1:]:
+            if not len(resultado) or not len(otra):
+                return np.empty(0, dtype=np.int64)
+            posiciones = np.minimum(np.searchsorted(otra, resultado), len(otra) - 1)
+            resultado = resultado[otra[posiciones] == resultado]
+        return resultado
+
+
+@st.cache_resource(show_spinner=False)
+def indice_filtros(tipo):
+    return IndiceFiltros()
+
+
+def cargar_indice_filtros(replica, tipo):
+    """Índice de filtros del tipo; se construye desde la réplica la primera vez."""
+    indice = indice_filtros(tipo)
+    contar_cache("filtros", indice.cargado)
+    if not indice.cargado:
+        with replica.locks_sync[tipo]:
+            if not indice.cargado:
+                indice.reconstruir(replica.consultar(tipo), replica.numeros(tipo))
+    return indice
+
+# ============================================================================
+# ÍNDICE DE OT-TE (unicidad por pestaña)
+# ============================================================================
+
+# Segundos tras los cuales el índice se vuelve a leer de la hoja
+TTL_INDICE_OT_TE = 300
+
+
+class IndiceOtTe:
+    """
+    Conjunto en memoria de los OT-TE de una pestaña de casos.
+    `reservar` comprueba y aparta un OT-TE en una sola operación con lock,
+    así dos sesiones que envían el mismo caso a la vez no lo duplican.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.existentes = set()
+        self.reservados = set()
+        # Confirmados por este proceso que aún no se han visto en la hoja
+        self.propios = set()
+        self.cargado_en = None
+
+    def vigente(self, ttl):
+        return self.cargado_en is not None and time.monotonic() - self.cargado_en < ttl
+
+    def cargar(self, valores):
+        with self.lock:
+            valores = {str(v).strip() for v in valores if str(v).strip()}
+            self.propios -= valores
+            self.existentes = valores | self.propios
+            self.cargado_en = time.monotonic()
+
+    def agregar(self, valores):
+        """Suma OT-TE leídos de filas nuevas; no hace nada si aún no se cargó."""
+        with self.lock:
+            if self.cargado_en is None:
+                return
+            self.existentes.update(str(v).strip() for v in valores if str(v).strip())
+            self.cargado_en = time.monotonic()
+
+    def reservar(self, ot_te):
+        with self.lock:
+            if ot_te in self.existentes or ot_te in self.reservados:
+                return False
+            self.reservados.add(ot_te)
+            return True
+
+    def confirmar(self, ot_te):
+        self.confirmar_varios([ot_te])
+
+    def liberar(self, ot_te):
+        self.liberar_varios([ot_te])
+
+    def ocupados(self, valores):
+        """Los OT-TE de `valores` que ya existen o están reservados."""
+        with self.lock:
+            return {v for v in valores if v in self.existentes or v in self.reservados}
+
+    def reservar_varios(self, valores):
+        """Aparta los OT-TE libres de `valores` y devuelve los que no se pudieron reservar."""
+        with self.lock:
+            tomados = {v for v in valores if v in self.existentes or v in self.reservados}
+            self.reservados.update(v for v in valores if v not in tomados)
+            return tomados
+
+    def confirmar_varios(self, valores):
+        with self.lock:
+            self.reservados.difference_update(valores)
+            self.existentes.update(valores)
+            self.propios.update(valores)
+
+    def liberar_varios(self, valores):
+        with self.lock:
+            self.reservados.difference_update(valores)
+
+    def descartar_varios(self, valores):
+        """Olvida OT-TE confirmados que nunca llegaron a la hoja (bitácora descartada)."""
+        with self.lock:
+            self.reservados.difference_update(valores)
+            self.propios.difference_update(valores)
+            self.existentes.difference_update(valores)
+
+
+@st.cache_resource(show_spinner=False)
+def indice_ot_te(tipo):
+    return IndiceOtTe()
+
+
+def cargar_indice_ot_te(tipo):
+    """
+    Devuelve el índice de OT-TE del tipo. Si venció, sincroniza la réplica
+    (solo filas nuevas) y, si hace falta, lo recarga desde ella.
+    """
+    indice = indice_ot_te(tipo)
+    ttl = st.secrets.get("ttl_ot_te", TTL_INDICE_OT_TE)
+    contar_cache("ot_te", indice.vigente(ttl))
+    if not indice.vigente(ttl):
+        replica = replica_casos()
+        with replica.locks_sync[tipo]:
+            sincronizar_replica(replica, [tipo])
+            if not indice.vigente(ttl):
+                # Los casos aún en la bitácora también cuentan como existentes
+                indice.cargar(replica.ot_te(tipo) | bitacora_casos().ot_te_pendientes(tipo))
+    return indice
+
+# ============================================================================
+# EXPORTACIÓN DE CASOS
+# ============================================================================
+
+# Filas que se leen de la réplica y se escriben por vez al armar un archivo
+TAMANO_BLOQUE_EXPORTACION = 20000
+# Archivos distintos (pestaña, filtros, versión, formato) que se conservan en memoria
+MAX_EXPORTACIONES = 8
+
+@functools.cache
+def esquema_parquet():
+    return pa.schema([
+        (c, pa.timestamp("ns") if c == "Timestamp" else pa.int8() if c == "Edad" else pa.string())
+        for c in ENCABEZADOS_CASOS
+    ])
+
+
+def _bloques_casos(replica, tipo, filas):
+    """DataFrames de a TAMANO_BLOQUE_EXPORTACION filas, en el orden de la hoja."""
+    for i in range(0, len(filas), TAMANO_BLOQUE_EXPORTACION):
+        yield construir_dataframe_casos(replica.consultar(tipo, filas[i:i + TAMANO_BLOQUE_EXPORTACION]))
+
+
+def _escribir_csv(destino, bloques, comprimir=False):
+    binario = gzip.GzipFile(fileobj=destino, mode="wb") if comprimir else destino
+    texto = io.TextIOWrapper(binario, encoding="utf-8-sig", newline="")
+    texto.write(",".join(ENCABEZADOS_CASOS) + "\n")
+    for df in bloques:
+        df.to_csv(texto, header=False, index=False)
+    texto.flush()
+    texto.detach()
+    if comprimir:
+        binario.close()
+
+
+def _escribir_parquet(destino, bloques):
+    with pq.ParquetWriter(destino, esquema_parquet(), compression="zstd") as escritor:
+        for df in bloques:
+            escritor.write_table(pa.Table.from_pandas(df, schema=esquema_parquet(), preserve_index=False))
+
+
+def _escribir_xlsx(destino, bloques):
+    # Modo write_only: openpyxl vuelca las filas a medida que llegan
+    libro = openpyxl.Workbook(write_only=True)
+    hoja = libro.create_sheet("Casos")
+    hoja.append(ENCABEZADOS_CASOS)
+    for df in bloques:
+        for fila in df.astype(object).where(df.notna(), None).itertuples(index=False, name=None):
+            hoja.append(fila)
+    libro.save(destino)
+
+
+# Etiqueta → (extensión, tipo MIME, escritor)
+FORMATOS_EXPORTACION = {
+    "CSV": (".csv", "text/csv", _escribir_csv),
+    "CSV comprimido": (".csv.gz", "application/gzip", lambda d, b: _escribir_csv(d, b, comprimir=True)),
+    "Parquet": (".parquet", "application/vnd.apache.parquet", _escribir_parquet),
+    "Excel": (".xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", _escribir_xlsx),
+}
+
+
+def filas_de_particion(filas, orden):
+    """Los números de fila (ordenados) de `filas` que caen en la partición de orden `orden`."""
+    base = orden * FILAS_POR_PARTICION
+    return filas[np.searchsorted(filas, base):np.searchsorted(filas, base + FILAS_POR_PARTICION)]
+
+
+@st.cache_resource(show_spinner=False, max_entries=MAX_EXPORTACIONES)
+def exportar_casos(_replica, tipo, filtros, version, formato, particion=None):
+    """
+    Archivo con los casos del tipo que cumplen `filtros` ((columna, valor),
+    ...), solo de la partición de orden `particion` si no es None. Se arma
+    por bloques desde la réplica y queda guardado por (tipo, filtros,
+    versión, formato, partición): volver a descargarlo no cuesta nada
+    hasta que la réplica cambie.
+    """
+    contar("cache.exportaciones.fallos")
+    filas = cargar_indice_filtros(_replica, tipo).filtrar(dict(filtros))
+    if particion is not None:
+        filas = filas_de_particion(filas, particion)
+    destino = io.BytesIO()
+    FORMATOS_EXPORTACION[formato][2](destino, _bloques_casos(_replica, tipo, filas))
+    logger.info("exportación %s %s: %d casos, %d bytes", tipo, formato, len(filas), destino.tell())
+    return destino.getvalue()
+
+# ============================================================================
+# ARCHIVO HISTÓRICO DE CASOS (Parquet local)
+# ============================================================================
+
+# Días de antigüedad con los que un caso sale de Sheets al archivo (0 = no se archiva)
+DIAS_ARCHIVO = 0
+# Horas entre corridas del archivado automático
+INTERVALO_ARCHIVO_HORAS = 24
+# Partición de la réplica que ocupan los casos archivados: sus números de
+# fila son negativos y quedan antes que los de Sheets
+ORDEN_ARCHIVO = -1
+# Valores tal como están en la hoja: archivar no pierde lo que no se pueda convertir
+@functools.cache
+def esquema_archivo():
+    return pa.schema([(c, pa.string()) for c in ENCABEZADOS_CASOS])
+
+
+def particion_archivo(tipo):
+    return {"tipo": tipo, "periodo": "Archivo", "libro": "", "pestana": f"archivo {tipo}",
+            "orden": ORDEN_ARCHIVO}
+
+
+def _directorio_archivo(tipo):
+    return os.path.join(st.secrets.get("ruta_archivo", "ismr_archivo"), tipo)
+
+
+def archivos_archivo(tipo):
+    """Parquets del tipo (uno por mes y corrida), del más antiguo al más reciente."""
+    return sorted(glob.glob(os.path.join(_directorio_archivo(tipo), "mes=*", "*.parquet")))
+
+
+def leer_archivo(tipo):
+    """Casos archivados del tipo como grilla de valores, igual que los devuelve Sheets."""
+    filas = []
+    for ruta in archivos_archivo(tipo):
+        tabla = pq.read_table(ruta, columns=ENCABEZADOS_CASOS)
+        filas.extend(list(fila) for fila in zip(*(tabla.column(c).to_pylist() for c in ENCABEZADOS_CASOS)))
+    return filas
+
+
+def escribir_archivo(tipo, filas):
+    """
+    Agrega `filas` al archivo del tipo: un Parquet comprimido por mes del
+    Timestamp, escrito aparte y renombrado para que nunca quede a medias.
+    """
+    n = len(ENCABEZADOS_CASOS)
+    por_mes = defaultdict(list)
+    for fila in filas:
+        por_mes[str(fila[0])[:7]].append([str(v) for v in fila[:n]] + [""] * (n - len(fila)))
+    sello = int(time.time() * 1000)
+    for mes, grupo in por_mes.items():
+        directorio = os.path.join(_directorio_archivo(tipo), f"mes={mes}")
+        os.makedirs(directorio, exist_ok=True)
+        ruta = os.path.join(directorio, f"{sello}.parquet")
+        tabla = pa.table([list(columna) for columna in zip(*grupo)], schema=esquema_archivo())
+        pq.write_table(tabla, ruta + ".tmp", compression="zstd")
+        os.replace(ruta + ".tmp", ruta)
+
+
+def sincronizar_archivo(replica, tipo):
+    """Carga el archivo del tipo en la réplica si cambió. Devuelve True si lo cargó."""
+    rutas = archivos_archivo(tipo)
+    particion = particion_archivo(tipo)
+    estado = replica.estado(particion)
+    huella = hashlib.sha1(json.dumps(
+        [(ruta, os.path.getsize(ruta), os.path.getmtime(ruta)) for ruta in rutas]
+    ).encode()).hexdigest()
+    if (estado is None and not rutas) or (estado is not None and estado["huella"] == huella):
+        return False
+    filas = leer_archivo(tipo)
+    replica.reemplazar(particion, filas, huella)
+    logger.info("archivo: %d casos %s cargados en la réplica", len(filas), tipo)
+    return True
+
+
+def archivar_casos(replica, tipo, dias):
+    """
+    Mueve al archivo los casos del tipo con más de `dias` días. De cada
+    partición se toma el tramo inicial de filas antiguas (los casos se
+    agregan en orden), se relee de Sheets para confirmar que coincide con
+    la réplica, se escribe en Parquet y solo entonces se borra de la hoja
+    con un solo delete_rows. Si el proceso muere entre ambos pasos, la
+    próxima corrida encuentra esos OT-TE ya archivados y solo los borra.
+    El archivo queda en el disco de la instancia que corre el proceso.
+    Devuelve cuántos casos salieron de Sheets.
+    """
+    limite = (datetime.now() - timedelta(days=dias)).strftime(FORMATO_TIMESTAMP)
+    movidos = 0
+    with replica.locks_sync[tipo], medir("archivo.archivar"):
+        sincronizar_replica(replica, [tipo])
+        columna = ENCABEZADOS_CASOS.index("OT-TE")
+        archivados = {str(fila[columna]) for fila in replica.de_particion(particion_archivo(tipo))}
+
+        for particion in cargar_manifiesto().de_tipo(tipo):
+            filas = replica.de_particion(particion)
+            antiguas = 0
+            while antiguas < len(filas) and filas[antiguas][0] and str(filas[antiguas][0]) < limite:
+                antiguas += 1
+            if not antiguas:
+                continue
+
+            worksheet = worksheet_particion(particion)
+            clave = (tipo, particion["orden"])
+            (actuales,) = _leer_rangos(
+                {clave: worksheet}, {clave: [f"A2:{ULTIMA_COLUMNA_CASOS}{antiguas + 1}"]}
+            )[clave]
+            if _huella(actuales) != _huella(filas[:antiguas]):
+                logger.warning("archivo: %s cambió desde la última sincronización; queda para la próxima corrida",
+                               particion["pestana"])
+                continue
+
+            escribir_archivo(tipo, [fila for fila in actuales if str(fila[columna]) not in archivados])
+            llamar_sheets(worksheet.delete_rows, 2, antiguas + 1)
+            replica.forzar_recarga(particion)
+            movidos += antiguas
+            logger.info("archivo: %d casos de %s archivados", antiguas, particion["pestana"])
+
+        if movidos:
+            sincronizar_replica(replica, [tipo])
+    return movidos
+
+
+def _bucle_archivo(replica, dias, intervalo):
+    while True:
+        for tipo in TABS_CASOS:
+            try:
+                archivar_casos(replica, tipo, dias)
+            except Exception:
+                logger.exception("archivo: corrida fallida para %s, se reintentará", tipo)
+        time.sleep(intervalo)
 
 # ============================================================================
 # AUTENTICACIÓN
 # ============================================================================
 
+def perfil_usuario(usuario):
+    """(nombre_completo, debe_cambiar_password, es_admin) del registro del directorio."""
+    debe_cambiar = str(usuario.get('debe_cambiar_password', 'FALSE')).upper() == 'TRUE'
+    es_admin = str(usuario.get('es_admin', 'FALSE')).upper() == 'TRUE'
+    return usuario.get('nombre_completo', usuario.get('username')), debe_cambiar, es_admin
+
+
 def verificar_credenciales(username, password):
+    """
+    (es_valido, nombre_completo, debe_cambiar, es_admin). Los errores de
+    Sheets o de formato de la hoja se propagan: no son credenciales malas.
+    """
     usuario = obtener_usuario(username)
     if not usuario:
         return False, None, False, False
-    try:
-        if 'password_hash' not in usuario:
-            st.error("❌ La hoja de usuarios no tiene el formato correcto. Verifica los encabezados.")
-            return False, None, False, False
-        password_hash = hashlib.sha256(password.encode()).hexdigest()
-        if password_hash == usuario['password_hash']:
-            debe_cambiar = str(usuario.get('debe_cambiar_password', 'FALSE')).upper() == 'TRUE'
-            es_admin = str(usuario.get('es_admin', 'FALSE')).upper() == 'TRUE'
-            nombre = usuario.get('nombre_completo', username)
-            return True, nombre, debe_cambiar, es_admin
-        return False, None, False, False
-    except Exception as e:
-        st.error(f"❌ Error en verificación: {str(e)}")
-        return False, None, False, False
+    if 'password_hash' not in usuario:
+        raise ValueError("La hoja de usuarios no tiene el formato correcto. Verifica los encabezados.")
+    password_hash = hashlib.sha256(password.encode()).hexdigest()
+    if password_hash == usuario['password_hash']:
+        return (True, *perfil_usuario(usuario))
+    return False, None, False, False
 
 def logout():
     for key in defaults:
         st.session_state[key] = defaults[key]
+    if PARAMETRO_SESION in st.query_params:
+        del st.query_params[PARAMETRO_SESION]
     st.rerun()
 
+# ============================================================================
+# SESIONES FIRMADAS (sobreviven a recargar la página)
+# ============================================================================
+
+# Horas de validez del token de sesión
+HORAS_SESION = 12
+# Parámetro de la URL que lleva el token
+PARAMETRO_SESION = "sesion"
+
+
+@st.cache_resource(show_spinner=False)
+def clave_sesion():
+    """
+    Clave HMAC de los tokens: el secret clave_sesion o, si no está, una
+    derivada de la llave privada de la cuenta de servicio. Sin ninguna de
+    las dos se genera al azar y los tokens no sobreviven a un reinicio.
+    """
+    clave = st.secrets.get("clave_sesion")
+    if clave:
+        return str(clave).encode()
+    privada = st.secrets["gcp_service_account"].get("private_key")
+    if privada:
+        return hashlib.sha256(b"ismr-sesion:" + privada.encode()).digest()
+    logger.warning("sesiones: sin clave_sesion ni private_key, los tokens se pierden al reiniciar")
+    return secrets.token_bytes(32)
+
+
+def _b64(datos):
+    return base64.urlsafe_b64encode(datos).rstrip(b"=").decode()
+
+
+def _firmar(cuerpo):
+    return _b64(hmac.new(clave_sesion(), cuerpo.encode(), hashlib.sha256).digest())
+
+
+def _huella_password(password_hash):
+    # Va dentro del token: cambiar la contraseña cambia la huella y revoca
+    # los tokens emitidos antes. Es un HMAC con la clave del servidor, así
+    # quien vea la URL no puede probar contraseñas contra ella
+    return _b64(hmac.new(clave_sesion(), b"password:" + str(password_hash).encode(), hashlib.sha256).digest())[:22]
+
+
+def emitir_token(username, password_hash):
+    # Solo identifica al usuario: nombre, rol y cambio obligatorio salen
+    # del directorio al restaurar, así rigen los cambios hechos después
+    horas = st.secrets.get("horas_sesion", HORAS_SESION)
+    datos = {
+        "u": username,
+        "p": _huella_password(password_hash),
+        "exp": int(time.time() + horas * 3600),
+    }
+    cuerpo = _b64(json.dumps(datos, separators=(",", ":"), ensure_ascii=False).encode())
+    return f"{cuerpo}.{_firmar(cuerpo)}"
+
+
+def validar_token(token):
+    """
+    Registro actual del usuario en el directorio si la firma del token es
+    válida, no venció y la contraseña no cambió desde que se emitió; si no,
+    None. Usa el directorio de usuarios en memoria y solo lee la hoja si el
+    proceso aún no lo cargó.
+    """
+    try:
+        cuerpo, firma = token.split(".")
+        if not hmac.compare_digest(firma, _firmar(cuerpo)):
+            return None
+        datos = json.loads(base64.urlsafe_b64decode(cuerpo + "=" * (-len(cuerpo) % 4)))
+        if datos["exp"] < time.time():
+            return None
+    except (ValueError, KeyError, TypeError):
+        return None
+
+    directorio = directorio_usuarios()
+    if directorio.cargado_en is None:
+        directorio = cargar_directorio()
+    usuario = directorio.obtener(datos["u"])
+    if not usuario or not hmac.compare_digest(_huella_password(usuario.get("password_hash")), str(datos["p"])):
+        return None
+    return usuario
+
+
+def guardar_sesion(password_hash):
+    """Deja en la URL el token de la sesión actual."""
+    st.query_params[PARAMETRO_SESION] = emitir_token(st.session_state.username, password_hash)
+
+
+def restaurar_sesion():
+    """
+    Si la URL trae un token válido, reconstruye la sesión sin pasar por el
+    login. Un token vencido, adulterado o revocado se quita de la URL.
+    """
+    token = st.query_params.get(PARAMETRO_SESION)
+    if not token:
+        return
+    try:
+        usuario = validar_token(token)
+    except Exception as e:
+        # Sheets no respondió al cargar el directorio: el token puede ser
+        # válido, así que se conserva para el próximo intento
+        logger.warning("sesiones: no se pudo validar el token: %s", e)
+        return
+    if usuario is None:
+        contar("sesiones.rechazadas")
+        del st.query_params[PARAMETRO_SESION]
+        return
+    # Rol y cambio obligatorio según el directorio de hoy, no el de la emisión
+    nombre_completo, debe_cambiar, es_admin = perfil_usuario(usuario)
+    st.session_state.autenticado = True
+    st.session_state.username = str(usuario["username"])
+    st.session_state.nombre_completo = nombre_completo
+    st.session_state.es_admin = es_admin
+    st.session_state.debe_cambiar_password = debe_cambiar
+    contar("sesiones.restauradas")
+
 # ============================================================================
 # PANTALLA: LOGIN
 # ============================================================================
 
+def importar_dependencias():
+    """Importa lo que usarán el formulario, el panel y las exportaciones."""
+    for nombre in ("pandas", "pyarrow.parquet", "openpyxl"):
+        importlib.import_module(nombre)
+
+
+def precalentar():
+    """
+    Recién autenticado el usuario, mientras ve la primera pantalla, carga
+    el manifiesto y los índices de OT-TE e importa las dependencias
+    pesadas, para que el formulario y el panel no esperen por nada. Solo
+    lecturas que lanzan sus errores (van al log): nada dibuja ni crea
+    pestañas, eso queda para el primer caso que se envíe.
+    """
+    en_segundo_plano(cargar_manifiesto)
+    for tipo in TABS_CASOS:
+        en_segundo_plano(cargar_indice_ot_te, tipo)
+    en_segundo_plano(importar_dependencias)
+
+
+@etapa("login_page")
 def login_page():
     st.title("🔐 Acceso al Sistema ISMR")
     st.markdown("---")
@@ -545,16 +2437,22 @@ def login_page():
 
         if submit:
             if username and password:
-                es_valido, nombre_completo, debe_cambiar, es_admin = verificar_credenciales(username, password)
-                if es_valido:
-                    st.session_state.autenticado = True
-                    st.session_state.username = username
-                    st.session_state.nombre_completo = nombre_completo
-                    st.session_state.debe_cambiar_password = debe_cambiar
-                    st.session_state.es_admin = es_admin
-                    st.rerun()
+                try:
+                    es_valido, nombre_completo, debe_cambiar, es_admin = verificar_credenciales(username, password)
+                except Exception as e:
+                    # Cuota agotada o Sheets caído: no es una contraseña incorrecta
+                    st.error(f"❌ No se pudo consultar la hoja de usuarios, intenta de nuevo: {str(e)}")
                 else:
-                    st.error("❌ Usuario o contraseña incorrectos")
+                    if es_valido:
+                        st.session_state.autenticado = True
+                        st.session_state.username = username
+                        st.session_state.nombre_completo = nombre_completo
+                        st.session_state.debe_cambiar_password = debe_cambiar
+                        st.session_state.es_admin = es_admin
+                        guardar_sesion(hashlib.sha256(password.encode()).hexdigest())
+                        st.rerun()
+                    else:
+                        st.error("❌ Usuario o contraseña incorrectos")
             else:
                 st.warning("⚠️ Por favor completa todos los campos")
 
@@ -593,6 +2491,8 @@ def pantalla_cambiar_password():
                 nuevo_hash = hashlib.sha256(nueva_password.encode()).hexdigest()
                 if actualizar_password(st.session_state.username, nuevo_hash, debe_cambiar=False):
                     st.session_state.debe_cambiar_password = False
+                    # El token anterior quedó revocado con la contraseña vieja
+                    guardar_sesion(nuevo_hash)
                     st.success("✅ ¡Contraseña actualizada!")
                     time.sleep(1)
                     st.rerun()
@@ -699,6 +2599,7 @@ def pantalla_selector():
 # FORMULARIO GENÉRICO (Individual o Colectivo)
 # ============================================================================
 
+@etapa("formulario_casos")
 def formulario_casos(tipo="individual"):
     """Formulario de registro — funciona para individual y colectivo"""
 
@@ -749,14 +2650,14 @@ def formulario_casos(tipo="individual"):
         col1, col2 = st.columns(2)
 
         with col1:
-            edad = st.number_input("Edad *", min_value=0, max_value=120, value=None)
-            sexo = st.selectbox("Sexo *", ["Seleccione...", "Hombre", "Mujer", "Otro", "No Reporta"])
+            edad = st.number_input("Edad *", min_value=0, max_value=EDAD_MAXIMA, value=None)
+            sexo = st.selectbox("Sexo *", ["Seleccione..."] + OPCIONES_SEXO)
             departamento = st.text_input("Departamento *", placeholder="Ejemplo: Antioquia")
 
         with col2:
             municipio = st.text_input("Municipio *", placeholder="Ejemplo: Medellín")
-            solicitante = st.selectbox("Entidad Solicitante *", ["Seleccione...", "ARN", "SESP", "OTRO"])
-            nivel_riesgo = st.selectbox("Nivel de Riesgo *", ["Seleccione...", "EXTRAORDINARIO", "EXTREMO", "ORDINARIO"])
+            solicitante = st.selectbox("Entidad Solicitante *", ["Seleccione..."] + OPCIONES_SOLICITANTE)
+            nivel_riesgo = st.selectbox("Nivel de Riesgo *", ["Seleccione..."] + OPCIONES_NIVEL_RIESGO)
 
         observaciones = st.text_area("Observaciones (Opcional)", height=100)
 
@@ -788,90 +2689,370 @@ def formulario_casos(tipo="individual"):
                     st.write(f"   • {e}")
             else:
                 try:
-                    todas_filas = worksheet.get_all_values()
-                    ot_existentes = [fila[1] for fila in todas_filas[1:]]
+                    ot_te = ot_te.strip()
+                    indice = cargar_indice_ot_te(tipo)
 
-                    if ot_te.strip() in ot_existentes:
+                    if not indice.reservar(ot_te):
                         st.error(f"❌ El caso '{ot_te}' ya existe en esta hoja")
                     else:
                         timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
                         nueva_fila = [
-                            timestamp, ot_te.strip(), edad, sexo,
+                            timestamp, ot_te, edad, sexo,
                             departamento.strip(), municipio.strip(),
                             solicitante, nivel_riesgo,
                             observaciones.strip() if observaciones else "",
                             st.session_state.nombre_completo,
                             st.session_state.username
                         ]
-                        worksheet.append_row(nueva_fila)
+                        try:
+                            bitacora_casos().encolar(tipo, ot_te, nueva_fila)
+                        except Exception:
+                            indice.liberar(ot_te)
+                            raise
+                        indice.confirmar(ot_te)
                         st.success(f"✅ Caso {ot_te} registrado en {label_badge}!")
                         st.balloons()
                 except Exception as e:
                     st.error(f"❌ Error al guardar: {str(e)}")
 
+    with st.expander("📤 Carga masiva desde archivo (CSV o Excel)"):
+        carga_masiva_casos(tipo, label_badge)
+
     st.markdown("---")
     st.caption(f"🔒 Los datos se guardan en la hoja '{label_badge.capitalize()}' de Google Sheets")
 
 
+# ============================================================================
+# CARGA MASIVA DE CASOS
+# ============================================================================
+
+COLUMNAS_CARGA = [
+    "OT-TE", "Edad", "Sexo", "Departamento", "Municipio",
+    "Solicitante", "Nivel de Riesgo", "Observaciones"
+]
+COLUMNAS_CARGA_OBLIGATORIAS = COLUMNAS_CARGA[:-1]
+MAX_FILAS_CARGA = 5000
+
+
+def leer_archivo_casos(archivo):
+    """
+    Lee el archivo subido como texto (sin que pandas adivine tipos) y
+    normaliza los encabezados a los nombres de COLUMNAS_CARGA sin
+    distinguir mayúsculas.
+    """
+    if archivo.name.lower().endswith(".xlsx"):
+        df = pd.read_excel(archivo, dtype=str, engine="openpyxl")
+    else:
+        # sep=None detecta ";" de los CSV que exporta Excel en español
+        df = pd.read_csv(archivo, dtype=str, sep=None, engine="python", encoding="utf-8-sig")
+    nombres = {c.upper(): c for c in COLUMNAS_CARGA}
+    df.columns = [nombres.get(str(c).strip().upper(), str(c).strip()) for c in df.columns]
+    return df.fillna("")
+
+
+def _normalizar_opcion(serie, opciones):
+    """Lleva cada valor a la forma exacta de `opciones` sin distinguir mayúsculas."""
+    return serie.str.upper().map({o.upper(): o for o in opciones}).fillna(serie)
+
+
+def validar_carga_casos(df, ocupados):
+    """
+    Aplica a todas las filas a la vez las reglas del formulario.
+    `ocupados` son los OT-TE que ya están en la hoja (o reservados).
+    Devuelve (aceptadas, errores): aceptadas con las columnas de carga
+    normalizadas y la edad como entero; errores con la fila del archivo
+    (contando el encabezado), el OT-TE y los motivos del rechazo.
+    """
+    datos = pd.DataFrame(
+        {c: df[c].astype(str).str.strip() if c in df else "" for c in COLUMNAS_CARGA},
+        index=df.index
+    )
+    datos["Sexo"] = _normalizar_opcion(datos["Sexo"], OPCIONES_SEXO)
+    datos["Solicitante"] = _normalizar_opcion(datos["Solicitante"], OPCIONES_SOLICITANTE)
+    datos["Nivel de Riesgo"] = _normalizar_opcion(datos["Nivel de Riesgo"], OPCIONES_NIVEL_RIESGO)
+
+    ot_te = datos["OT-TE"]
+    edad = pd.to_numeric(datos["Edad"], errors="coerce")
+    con_ot_te = ot_te != ""
+
+    reglas = [
+        (~con_ot_te, "El campo OT-TE es obligatorio"),
+        (~(edad.between(1, EDAD_MAXIMA) & (edad == edad.round())),
+         f"La edad debe ser un entero entre 1 y {EDAD_MAXIMA}"),
+        (~datos["Sexo"].isin(OPCIONES_SEXO), f"Sexo debe ser uno de: {', '.join(OPCIONES_SEXO)}"),
+        (datos["Departamento"] == "", "El departamento es obligatorio"),
+        (datos["Municipio"] == "", "El municipio es obligatorio"),
+        (~datos["Solicitante"].isin(OPCIONES_SOLICITANTE),
+         f"Solicitante debe ser uno de: {', '.join(OPCIONES_SOLICITANTE)}"),
+        (~datos["Nivel de Riesgo"].isin(OPCIONES_NIVEL_RIESGO),
+         f"Nivel de Riesgo debe ser uno de: {', '.join(OPCIONES_NIVEL_RIESGO)}"),
+        (con_ot_te & ot_te.isin(ocupados), "El caso ya existe en esta hoja"),
+        (con_ot_te & ot_te.duplicated(), "OT-TE repetido en el archivo"),
+    ]
+    motivos = pd.concat(
+        [pd.Series(mensaje, index=datos.index[mascara], dtype=object) for mascara, mensaje in reglas]
+    )
+    motivos = motivos.groupby(level=0).agg("; ".join)
+
+    errores = pd.DataFrame({
+        "Fila": motivos.index + 2,
+        "OT-TE": ot_te[motivos.index].values,
+        "Error": motivos.values,
+    })
+    aceptadas = datos.drop(index=motivos.index)
+    aceptadas["Edad"] = edad[aceptadas.index].astype(int)
+    return aceptadas, errores
+
+
+def registrar_carga_casos(tipo, aceptadas):
+    """
+    Reserva los OT-TE de las filas aceptadas y las encola juntas en la
+    bitácora, que las envía en lotes de TAMANO_LOTE_BITACORA filas.
+    Devuelve los OT-TE que otra sesión registró mientras tanto.
+    """
+    indice = cargar_indice_ot_te(tipo)
+    tomados = indice.reservar_varios(aceptadas["OT-TE"].tolist())
+    aceptadas = aceptadas[~aceptadas["OT-TE"].isin(tomados)]
+    reservados = aceptadas["OT-TE"].tolist()
+
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    analista = [st.session_state.nombre_completo, st.session_state.username]
+    casos = [
+        (fila[0], [timestamp, fila[0], int(fila[1]), *fila[2:]] + analista)
+        for fila in aceptadas[COLUMNAS_CARGA].itertuples(index=False, name=None)
+    ]
+    try:
+        bitacora_casos().encolar_varios(tipo, casos)
+    except Exception:
+        indice.liberar_varios(reservados)
+        raise
+    indice.confirmar_varios(reservados)
+    return tomados
+
+
+def carga_masiva_casos(tipo, label_badge):
+    """Sube un CSV/XLSX con las columnas del formulario, lo valida completo y registra las filas válidas."""
+    st.caption(
+        f"Columnas: {', '.join(COLUMNAS_CARGA)} (Observaciones es opcional). "
+        f"Máximo {MAX_FILAS_CARGA} filas por archivo."
+    )
+    archivo = st.file_uploader("Archivo de casos", type=["csv", "xlsx"], key=f"carga_{tipo}")
+    if archivo is None:
+        return
+
+    try:
+        df = leer_archivo_casos(archivo)
+    except Exception as e:
+        st.error(f"❌ No se pudo leer el archivo: {str(e)}")
+        return
+
+    faltantes = [c for c in COLUMNAS_CARGA_OBLIGATORIAS if c not in df.columns]
+    if faltantes:
+        st.error(f"❌ Faltan columnas en el archivo: {', '.join(faltantes)}")
+        return
+    if df.empty:
+        st.warning("El archivo no tiene filas")
+        return
+    if len(df) > MAX_FILAS_CARGA:
+        st.error(f"❌ El archivo tiene {len(df)} filas; el máximo es {MAX_FILAS_CARGA}")
+        return
+
+    try:
+        indice = cargar_indice_ot_te(tipo)
+        with medir("carga.validar"):
+            aceptadas, errores = validar_carga_casos(df, indice.ocupados(set(df["OT-TE"].str.strip())))
+    except Exception as e:
+        st.error(f"❌ Error al validar el archivo: {str(e)}")
+        return
+
+    col1, col2 = st.columns(2)
+    col1.metric("Filas válidas", len(aceptadas))
+    col2.metric("Filas con errores", len(errores))
+
+    if not errores.empty:
+        st.dataframe(errores, use_container_width=True, hide_index=True)
+        st.download_button(
+            "📥 Descargar reporte de errores",
+            errores.to_csv(index=False).encode("utf-8-sig"),
+            file_name=f"errores_carga_{tipo}.csv",
+            mime="text/csv",
+            key=f"errores_carga_{tipo}"
+        )
+
+    if aceptadas.empty:
+        return
+
+    if st.button(f"✅ REGISTRAR {len(aceptadas)} CASOS {label_badge}", key=f"registrar_carga_{tipo}",
+                 type="primary", use_container_width=True):
+        try:
+            with medir("carga.registrar"):
+                tomados = registrar_carga_casos(tipo, aceptadas)
+        except Exception as e:
+            st.error(f"❌ Error al guardar: {str(e)}")
+            return
+        st.success(f"✅ {len(aceptadas) - len(tomados)} casos registrados en {label_badge}!")
+        if tomados:
+            st.warning(f"Otra sesión registró antes estos OT-TE: {', '.join(sorted(tomados))}")
+
+
 # ============================================================================
 # PANEL VISUALIZACIÓN (Admin)
 # ============================================================================
 
+# Segundos que el panel espera a Sheets antes de mostrar lo que ya tiene
+ESPERA_PANEL = 20
+# Filas por página de la tabla de resultados
+TAMANOS_PAGINA = [25, 50, 100, 250]
+TAMANO_PAGINA = 50
+
+
+def cargar_tab_casos(replica, tipo):
+    """Enlace de la hoja actual, resumen, índice de filtros y particiones (con el archivo) de un tipo."""
+    url = obtener_worksheet_casos(tipo).spreadsheet.url
+    particiones = cargar_manifiesto().de_tipo(tipo)
+    archivo = replica.estado(particion_archivo(tipo))
+    if archivo and archivo["filas"]:
+        particiones = [particion_archivo(tipo)] + particiones
+    return url, cargar_resumen(replica, tipo), cargar_indice_filtros(replica, tipo), particiones
+
+
+def tabla_paginada(replica, tipo, filas, filtrado):
+    """
+    Muestra una página de los casos `filas` (números de fila ya filtrados).
+    Orden y recorte los resuelve la réplica; al navegador solo viaja la
+    página actual.
+    """
+    total = len(filas)
+    col_orden, col_sentido, col_tamano, col_pagina = st.columns([3, 2, 2, 2])
+    with col_orden:
+        orden = st.selectbox("Ordenar por", ["Orden de la hoja"] + ENCABEZADOS_CASOS, key=f"orden_{tipo}")
+    with col_sentido:
+        sentido = st.selectbox("Sentido", ["Ascendente", "Descendente"], key=f"sentido_{tipo}")
+    with col_tamano:
+        tamano = st.selectbox("Filas por página", TAMANOS_PAGINA,
+                              index=TAMANOS_PAGINA.index(TAMANO_PAGINA), key=f"tamano_{tipo}")
+    n_paginas = max(1, -(-total // tamano))
+    # La página vive solo en session_state (el widget no lleva value=); si
+    # cambiaron los filtros o el tamaño, la guardada puede ya no existir
+    st.session_state[f"pagina_{tipo}"] = min(st.session_state.get(f"pagina_{tipo}", 1), n_paginas)
+    with col_pagina:
+        pagina = st.number_input(f"Página (de {n_paginas})", min_value=1, max_value=n_paginas,
+                                 step=1, key=f"pagina_{tipo}")
+
+    desde = (pagina - 1) * tamano
+    registros = replica.pagina(
+        tipo, filas if filtrado else None,
+        orden=None if orden == "Orden de la hoja" else orden,
+        descendente=sentido == "Descendente",
+        limite=tamano, desde=desde,
+    )
+    df_pagina = construir_dataframe_casos(registros)
+
+    st.subheader(f"📋 Resultados ({total} casos)")
+    st.caption(f"Mostrando {desde + 1 if total else 0}–{desde + len(df_pagina)} de {total}")
+    st.dataframe(df_pagina, use_container_width=True, hide_index=True)
+
+
+@etapa("panel_visualizacion")
 def panel_visualizacion():
     st.title("📊 Casos Registrados")
     st.markdown("---")
 
+    replica = replica_casos()
+    # Ambas pestañas se sincronizan juntas, en una sola llamada a Sheets
+    pendientes = [t for t in TABS_CASOS if replica.sincronizado_en(t) is None]
+    if st.button("🔄 Sincronizar ahora", key="sync_casos"):
+        pendientes = list(TABS_CASOS)
+
+    # La sincronización y la carga de cada pestaña corren a la vez; si una
+    # se demora, el resto de la página se muestra igual
+    tareas = {tipo: (cargar_tab_casos, replica, tipo) for tipo in TABS_CASOS}
+    if pendientes:
+        tareas["sync"] = (sincronizar_replica, replica, pendientes)
+    with st.spinner("Cargando casos..."):
+        resultados = en_paralelo(tareas, timeout=st.secrets.get("espera_panel", ESPERA_PANEL))
+
+    _, error_sync = resultados.pop("sync", (None, None))
+    if isinstance(error_sync, TimeoutError):
+        st.warning("⏳ Google Sheets tarda en responder; se muestra la última copia local")
+    elif error_sync is not None:
+        st.error(f"No se pudo sincronizar con Google Sheets: {str(error_sync)}")
+
     tab_ind, tab_col = st.tabs(["👤 Individual", "👥 Colectivo"])
 
     for tab, tipo in [(tab_ind, "individual"), (tab_col, "colectivo")]:
         with tab:
-            worksheet, sheet_url = conectar_sheet_casos(tipo)
-            if worksheet is None:
-                st.error(f"No se pudo conectar a la hoja {tipo}")
+            sincronizado_en = replica.sincronizado_en(tipo)
+            if sincronizado_en is None:
+                st.error(f"No se pudo cargar la hoja {tipo}")
                 continue
 
-            if sheet_url:
-                st.markdown(f"[📝 Abrir en Google Sheets]({sheet_url})")
+            carga, error = resultados[tipo]
+            if error is not None:
+                st.error(f"Error al cargar datos: {str(error)}")
+                continue
+            sheet_url, resumen, indice, particiones = carga
+            st.markdown(f"[📝 Abrir en Google Sheets]({sheet_url})")
+            st.caption(f"🗄️ Réplica local actualizada hace {int(time.time() - sincronizado_en)} s")
 
             try:
-                datos = worksheet.get_all_records()
-                if datos:
-                    df = pd.DataFrame(datos)
-
+                total, n_deptos, n_municipios, riesgo_alto = resumen.metricas()
+                if total:
                     c1, c2, c3, c4 = st.columns(4)
-                    c1.metric("Total Casos", len(df))
-                    c2.metric("Departamentos", df['Departamento'].nunique() if 'Departamento' in df.columns else 0)
-                    c3.metric("Municipios", df['Municipio'].nunique() if 'Municipio' in df.columns else 0)
-                    riesgo_alto = df['Nivel de Riesgo'].isin(['EXTREMO', 'EXTRAORDINARIO']).sum() if 'Nivel de Riesgo' in df.columns else 0
+                    c1.metric("Total Casos", total)
+                    c2.metric("Departamentos", n_deptos)
+                    c3.metric("Municipios", n_municipios)
                     c4.metric("Riesgo Alto", riesgo_alto)
 
-                    col1, col2, col3 = st.columns(3)
-                    with col1:
-                        depto = st.selectbox("Departamento", ["Todos"] + sorted(df['Departamento'].unique().tolist()) if 'Departamento' in df.columns else ["Todos"], key=f"depto_{tipo}")
-                    with col2:
-                        riesgo = st.selectbox("Nivel de Riesgo", ["Todos"] + sorted(df['Nivel de Riesgo'].unique().tolist()) if 'Nivel de Riesgo' in df.columns else ["Todos"], key=f"riesgo_{tipo}")
-                    with col3:
-                        analista_f = st.selectbox("Analista", ["Todos"] + sorted(df['Analista'].unique().tolist()) if 'Analista' in df.columns else ["Todos"], key=f"analista_{tipo}")
-
-                    df_f = df.copy()
-                    if depto != "Todos" and 'Departamento' in df.columns:
-                        df_f = df_f[df_f['Departamento'] == depto]
-                    if riesgo != "Todos" and 'Nivel de Riesgo' in df.columns:
-                        df_f = df_f[df_f['Nivel de Riesgo'] == riesgo]
-                    if analista_f != "Todos" and 'Analista' in df.columns:
-                        df_f = df_f[df_f['Analista'] == analista_f]
-
-                    st.subheader(f"📋 Resultados ({len(df_f)} casos)")
-                    st.dataframe(df_f, use_container_width=True)
-
-                    csv = df_f.to_csv(index=False, encoding='utf-8-sig')
-                    st.download_button(
-                        f"📥 Descargar CSV {tipo}",
-                        data=csv,
-                        file_name=f"casos_{tipo}_{datetime.now().strftime('%Y%m%d')}.csv",
-                        mime="text/csv",
-                        key=f"download_{tipo}"
-                    )
+                    filtros = {}
+                    columnas = st.columns(len(COLUMNAS_FILTRO) + (len(particiones) > 1))
+                    for col, columna in zip(columnas, COLUMNAS_FILTRO):
+                        with col:
+                            valor = st.selectbox(columna, ["Todos"] + indice.valores(columna),
+                                                 key=f"filtro_{columna}_{tipo}")
+                        if valor != "Todos":
+                            filtros[columna] = valor
+                    filas = indice.filtrar(filtros)
+
+                    # Con particiones, elegir un periodo limita la consulta a su rango de filas
+                    particion = None
+                    if len(particiones) > 1:
+                        periodos = {p["periodo"] or "Histórico": p["orden"] for p in reversed(particiones)}
+                        with columnas[-1]:
+                            periodo = st.selectbox("Periodo", ["Todos"] + list(periodos),
+                                                   key=f"periodo_{tipo}")
+                        if periodo != "Todos":
+                            particion = periodos[periodo]
+                            filas = filas_de_particion(filas, particion)
+                    tabla_paginada(replica, tipo, filas, bool(filtros) or particion is not None)
+
+                    # El archivo se arma solo cuando se pide, y queda en caché
+                    # mientras no cambien los filtros ni los datos
+                    col_formato, col_preparar = st.columns([3, 1])
+                    with col_formato:
+                        formato = st.selectbox("Formato de descarga", list(FORMATOS_EXPORTACION),
+                                               key=f"formato_{tipo}")
+                    clave = (tipo, tuple(sorted(filtros.items())), replica.version(tipo), formato, particion)
+                    with col_preparar:
+                        preparar = st.button("📦 Preparar", key=f"exportar_{tipo}", use_container_width=True)
+                    if preparar:
+                        st.session_state[f"exportacion_{tipo}"] = clave
+                        # Solo cuenta el pedido: en los reruns siguientes el
+                        # archivo se vuelve a tomar de la caché para dibujar el botón
+                        contar("cache.exportaciones.consultas")
+                    if st.session_state.get(f"exportacion_{tipo}") == clave:
+                        with st.spinner("Generando archivo..."):
+                            archivo = exportar_casos(replica, *clave)
+                        extension, mime, _ = FORMATOS_EXPORTACION[formato]
+                        if st.download_button(
+                            f"📥 Descargar {formato} {tipo}",
+                            data=archivo,
+                            file_name=f"casos_{tipo}_{datetime.now().strftime('%Y%m%d')}{extension}",
+                            mime=mime,
+                            key=f"download_{tipo}"
+                        ):
+                            # Descarga servida desde la caché, sin volver a armarlo
+                            contar("cache.exportaciones.consultas")
                 else:
                     st.info(f"📭 No hay casos {tipo}s registrados")
             except Exception as e:
@@ -881,11 +3062,12 @@ def panel_visualizacion():
 # PANEL GESTIÓN USUARIOS (Admin)
 # ============================================================================
 
+@etapa("panel_gestion_usuarios")
 def panel_gestion_usuarios():
     st.title("👥 Gestión de Usuarios")
     st.markdown("---")
 
-    tab1, tab2, tab3 = st.tabs(["➕ Crear Usuario", "📋 Ver Usuarios", "🔑 Ver Hashes"])
+    tab1, tab2, tab3, tab4 = st.tabs(["➕ Crear Usuario", "📋 Ver Usuarios", "🔑 Ver Hashes", "🛠️ Mantenimiento"])
 
     with tab1:
         st.subheader("➕ Crear Nuevo Usuario")
@@ -912,6 +3094,9 @@ def panel_gestion_usuarios():
                 else:
                     st.warning("⚠️ Completa todos los campos")
 
+        with st.expander("📤 Alta masiva desde CSV"):
+            alta_masiva_usuarios()
+
     with tab2:
         st.subheader("📋 Lista de Usuarios")
         usuarios = listar_usuarios()
@@ -923,6 +3108,28 @@ def panel_gestion_usuarios():
             c2.metric("Admins", admins)
             c3.metric("Analistas", len(df) - admins)
             st.dataframe(df[['username', 'nombre_completo', 'es_admin', 'debe_cambiar_password']], use_container_width=True)
+
+            st.markdown("---")
+            st.subheader("🔑 Forzar cambio de contraseña")
+            with st.form("forzar_cambio_form"):
+                seleccion = st.multiselect("Usuarios", sorted(df['username'].astype(str)))
+                password_temporal = st.text_input(
+                    "Contraseña temporal (opcional)", type="password",
+                    help="Si se deja vacía, conservan su contraseña actual pero deben cambiarla al entrar"
+                )
+                if st.form_submit_button("🔑 Forzar cambio", use_container_width=True):
+                    if not seleccion:
+                        st.warning("⚠️ Selecciona al menos un usuario")
+                    elif password_temporal and len(password_temporal) < 6:
+                        st.error("❌ La contraseña temporal debe tener al menos 6 caracteres")
+                    else:
+                        password_hash = (hashlib.sha256(password_temporal.encode()).hexdigest()
+                                         if password_temporal else None)
+                        try:
+                            actualizados = forzar_cambio_password(seleccion, password_hash)
+                            st.success(f"✅ {len(actualizados)} usuarios deberán cambiar su contraseña")
+                        except Exception as e:
+                            st.error(f"❌ Error al actualizar usuarios: {str(e)}")
         else:
             st.info("📭 No hay usuarios")
 
@@ -936,16 +3143,250 @@ def panel_gestion_usuarios():
                     st.code(u.get('password_hash', 'N/A'), language=None)
                     st.caption(f"Debe cambiar: {u.get('debe_cambiar_password', 'N/A')}")
 
+    with tab4:
+        st.subheader("🛠️ Mantenimiento")
+        st.caption("Los encabezados de cada hoja se verifican una vez por proceso. "
+                   "Úsalo si alguien editó o recreó las hojas a mano.")
+        if st.button("🔄 Re-verificar esquemas", key="reverificar_esquemas"):
+            pool_sheets().reverificar_esquemas()
+            manifiesto_particiones().invalidar()
+            try:
+                conectar_sheet_usuarios()
+            except Exception as e:
+                st.error(f"Error al conectar sheet de usuarios: {str(e)}")
+            for tipo in ["individual", "colectivo"]:
+                conectar_sheet_casos(tipo)
+            st.success("✅ Esquemas verificados")
+
+        pendientes = bitacora_casos().contar_pendientes()
+        st.caption(f"Casos en la bitácora local pendientes de enviar a Sheets: "
+                   f"{sum(pendientes.values())}")
+        if st.button("📤 Enviar pendientes ahora", key="enviar_bitacora"):
+            bitacora_casos().despertar.set()
+            st.success("✅ Envío solicitado")
+
+        apartados = bitacora_casos().apartados()
+        if apartados:
+            st.warning(f"⚠️ {len(apartados)} casos apartados: Sheets rechazó sus datos "
+                       f"{MAX_INTENTOS_BITACORA} veces y ya no se reintentan solos.")
+            st.dataframe(pd.DataFrame(
+                [(tipo.upper(), ot_te, intentos, error, datetime.fromtimestamp(apartado_en).strftime("%Y-%m-%d %H:%M"))
+                 for _, tipo, ot_te, intentos, error, apartado_en in apartados],
+                columns=["Tipo", "OT-TE", "Intentos", "Último error", "Apartado"]
+            ), use_container_width=True, hide_index=True)
+            ids = [id_ for id_, *_ in apartados]
+            col1, col2 = st.columns(2)
+            with col1:
+                if st.button("🔁 Reintentar apartados", key="reencolar_bitacora", use_container_width=True):
+                    bitacora_casos().reencolar(ids)
+                    st.rerun()
+            with col2:
+                if st.button("🗑️ Descartar apartados", key="descartar_bitacora", use_container_width=True):
+                    for tipo, valores in bitacora_casos().descartar(ids).items():
+                        indice_ot_te(tipo).descartar_varios(valores)
+                    st.rerun()
+
+        dias_archivo = st.secrets.get("dias_archivo", DIAS_ARCHIVO)
+        if dias_archivo:
+            st.caption(f"Los casos con más de {dias_archivo} días pasan de Google Sheets al archivo "
+                       f"local en Parquet ({sum(len(archivos_archivo(t)) for t in TABS_CASOS)} archivos).")
+            if st.button("🗄️ Archivar casos antiguos ahora", key="archivar_casos"):
+                try:
+                    movidos = sum(archivar_casos(replica_casos(), tipo, dias_archivo) for tipo in TABS_CASOS)
+                    st.success(f"✅ {movidos} casos archivados")
+                except Exception as e:
+                    st.error(f"❌ Error al archivar: {str(e)}")
+
+        st.caption("El directorio de usuarios se guarda en memoria por unos minutos. "
+                   "Recárgalo si editaste la hoja de usuarios directamente.")
+        if st.button("🔄 Recargar directorio de usuarios", key="recargar_directorio"):
+            directorio_usuarios().invalidar()
+            try:
+                cargar_directorio()
+            except Exception as e:
+                st.error(f"Error al conectar sheet de usuarios: {str(e)}")
+            else:
+                st.success("✅ Directorio recargado")
+
+ROLES_USUARIO = {"ADMIN": True, "ADMINISTRADOR": True, "ANALISTA": False, "": False}
+
+
+def validar_alta_usuarios(df, existentes):
+    """
+    Valida el CSV de alta masiva (username, nombre_completo, rol y, si
+    viene, password) de una vez. Devuelve (aceptados, errores) como
+    DataFrames; errores con la fila del archivo, el username y el motivo.
+    """
+    datos = pd.DataFrame(
+        {c: df[c].astype(str).str.strip() if c in df else ""
+         for c in ["username", "nombre_completo", "rol", "password"]},
+        index=df.index
+    )
+    username = datos["username"]
+    con_username = username != ""
+    rol = datos["rol"].str.upper()
+
+    reglas = [
+        (~con_username, "El usuario es obligatorio"),
+        (datos["nombre_completo"] == "", "El nombre completo es obligatorio"),
+        (~rol.isin(ROLES_USUARIO), "El rol debe ser admin o analista"),
+        ((datos["password"] != "") & (datos["password"].str.len() < 6),
+         "La contraseña debe tener al menos 6 caracteres"),
+        (con_username & username.isin(existentes), "El usuario ya existe"),
+        (con_username & username.duplicated(), "Usuario repetido en el archivo"),
+    ]
+    motivos = pd.concat(
+        [pd.Series(mensaje, index=datos.index[mascara], dtype=object) for mascara, mensaje in reglas]
+    )
+    motivos = motivos.groupby(level=0).agg("; ".join)
+
+    errores = pd.DataFrame({
+        "Fila": motivos.index + 2,
+        "Usuario": username[motivos.index].values,
+        "Error": motivos.values,
+    })
+    aceptados = datos.drop(index=motivos.index)
+    aceptados["es_admin"] = rol[aceptados.index].map(ROLES_USUARIO)
+    return aceptados, errores
+
+
+def alta_masiva_usuarios():
+    """Crea usuarios desde un CSV; quien no trae contraseña recibe una temporal aleatoria."""
+    st.caption("Columnas: username, nombre_completo, rol (admin o analista) y, opcional, password. "
+               "Todos deberán cambiar la contraseña en su primer acceso.")
+    archivo = st.file_uploader("Archivo CSV", type=["csv"], key="alta_usuarios")
+    if archivo is None:
+        return
+
+    try:
+        df = pd.read_csv(archivo, dtype=str, sep=None, engine="python", encoding="utf-8-sig").fillna("")
+        df.columns = [str(c).strip().lower() for c in df.columns]
+    except Exception as e:
+        st.error(f"❌ No se pudo leer el archivo: {str(e)}")
+        return
+    faltantes = [c for c in ["username", "nombre_completo"] if c not in df.columns]
+    if faltantes:
+        st.error(f"❌ Faltan columnas en el archivo: {', '.join(faltantes)}")
+        return
+
+    try:
+        existentes = {u["username"] for u in cargar_directorio().listar()}
+        aceptados, errores = validar_alta_usuarios(df, existentes)
+    except Exception as e:
+        st.error(f"❌ Error al validar el archivo: {str(e)}")
+        return
+
+    c1, c2 = st.columns(2)
+    c1.metric("Usuarios válidos", len(aceptados))
+    c2.metric("Filas con errores", len(errores))
+    if not errores.empty:
+        st.dataframe(errores, use_container_width=True, hide_index=True)
+
+    if aceptados.empty:
+        return
+
+    if st.button(f"✅ Crear {len(aceptados)} usuarios", key="crear_usuarios_masivo",
+                 type="primary", use_container_width=True):
+        passwords = [p or secrets.token_urlsafe(9) for p in aceptados["password"]]
+        nuevos = [
+            {
+                "username": u,
+                "password_hash": hashlib.sha256(p.encode()).hexdigest(),
+                "nombre_completo": nombre,
+                "es_admin": str(es_admin).upper(),
+                "debe_cambiar_password": "TRUE",
+            }
+            for u, nombre, es_admin, p in zip(
+                aceptados["username"], aceptados["nombre_completo"], aceptados["es_admin"], passwords
+            )
+        ]
+        try:
+            creados, omitidos = crear_usuarios(nuevos)
+        except Exception as e:
+            st.error(f"❌ Error al crear usuarios: {str(e)}")
+            return
+        st.success(f"✅ {len(creados)} usuarios creados")
+        if omitidos:
+            st.warning(f"Ya existían: {', '.join(omitidos)}")
+        credenciales = pd.DataFrame({"username": aceptados["username"], "password_temporal": passwords})
+        credenciales = credenciales[credenciales["username"].isin(creados)]
+        # Las contraseñas temporales solo se muestran ahora: no quedan en ningún lado
+        st.download_button(
+            "📥 Descargar contraseñas temporales",
+            credenciales.to_csv(index=False).encode("utf-8-sig"),
+            file_name="usuarios_nuevos.csv",
+            mime="text/csv",
+            key="descargar_credenciales"
+        )
+
+# ============================================================================
+# PANEL RENDIMIENTO (Admin)
+# ============================================================================
+
+def panel_rendimiento():
+    st.title("⏱️ Rendimiento")
+    st.markdown("---")
+    metricas = metricas_rendimiento()
+    st.caption(f"Últimas {MUESTRAS_RENDIMIENTO} mediciones por nombre, desde que arrancó el proceso "
+               "o se reiniciaron las métricas")
+
+    contadores = metricas.contadores
+    c1, c2, c3, c4 = st.columns(4)
+    c1.metric("Llamadas a Sheets", contadores["sheets.llamadas"])
+    c2.metric("Peticiones HTTP", contadores["sheets.peticiones"])
+    c3.metric("MB recibidos", f"{contadores['sheets.bytes'] / 1e6:.2f}")
+    c4.metric("Reintentos", contadores["sheets.reintentos"])
+
+    tab_tiempos, tab_cache, tab_acciones = st.tabs(["⏱️ Tiempos", "🗃️ Cachés", "🖱️ Acciones recientes"])
+
+    with tab_tiempos:
+        percentiles = metricas.percentiles()
+        if percentiles:
+            st.dataframe(pd.DataFrame(percentiles), use_container_width=True, hide_index=True)
+        else:
+            st.info("Aún no hay mediciones")
+
+    with tab_cache:
+        tasas = metricas.tasas_cache()
+        if tasas:
+            st.dataframe(pd.DataFrame(tasas), use_container_width=True, hide_index=True)
+        else:
+            st.info("Aún no hay consultas a cachés")
+
+    with tab_acciones:
+        acciones = list(metricas.acciones)[::-1]
+        if acciones:
+            st.dataframe(pd.DataFrame(acciones).drop(columns="evento"), use_container_width=True, hide_index=True)
+        else:
+            st.info("Aún no hay acciones registradas")
+
+    if st.button("🧹 Reiniciar métricas", key="reiniciar_metricas"):
+        metricas.reiniciar()
+        st.rerun()
+
 # ============================================================================
 # MAIN
 # ============================================================================
 
 def main():
+    # Con el primer visitante arranca el envío de la bitácora, así lo que
+    # quedó pendiente antes de reiniciar no espera a un formulario o al panel
+    bitacora_casos()
+
+    # 0. Recarga de la página → sesión desde el token de la URL
+    if not st.session_state.autenticado:
+        restaurar_sesion()
+
     # 1. No autenticado → Login
     if not st.session_state.autenticado:
         login_page()
         return
 
+    # Una vez por sesión y solo con usuario: nada se toca por un visitante anónimo
+    if not st.session_state.get("precalentado"):
+        st.session_state.precalentado = True
+        precalentar()
+
     # 2. Debe cambiar contraseña → Forzar
     if st.session_state.debe_cambiar_password:
         pantalla_cambiar_password()
@@ -959,7 +3400,8 @@ def main():
 
         opcion = st.sidebar.radio(
             "Menú",
-            ["🏠 Inicio", "👤 Individual", "👥 Colectivo", "📊 Ver Datos", "👥 Gestionar Usuarios"]
+            ["🏠 Inicio", "👤 Individual", "👥 Colectivo", "📊 Ver Datos", "👥 Gestionar Usuarios",
+             "⏱️ Rendimiento"]
         )
 
         if st.sidebar.button("🚪 Cerrar Sesión", use_container_width=True):
@@ -973,6 +3415,8 @@ def main():
             formulario_casos("colectivo")
         elif opcion == "📊 Ver Datos":
             panel_visualizacion()
+        elif opcion == "⏱️ Rendimiento":
+            panel_rendimiento()
         else:
             panel_gestion_usuarios()
         return
@@ -989,4 +3433,5 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    with accion_usuario():
+        main()
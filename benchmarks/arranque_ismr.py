@@ -0,0 +1,109 @@
+"""
+Tiempo de arranque de la app ISMR, sin red: importación del módulo y
+primer pintado de la pantalla de login, cada medición en un proceso
+nuevo que ya tiene streamlit importado (como el servidor al recibir al
+primer visitante). Informa también qué dependencias pesadas quedaron
+cargadas tras importar la app.
+
+    python benchmarks/arranque_ismr.py --repeticiones 10
+    python benchmarks/arranque_ismr.py --salida arranque.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+from datetime import datetime
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APP = os.path.join(RAIZ, "app_ismr_sheets.py")
+
+PESADOS = ["pandas", "numpy", "pyarrow", "openpyxl", "gspread", "google.oauth2.service_account", "requests"]
+
+# Cada medición corre en un intérprete limpio; imprime un JSON en la última línea
+PREAMBULO = f"""
+import importlib, json, logging, sys, time
+t = time.perf_counter()
+import streamlit
+from streamlit import logger as st_logger
+streamlit_ms = (time.perf_counter() - t) * 1000
+st_logger.set_log_level("error")
+logging.disable(logging.WARNING)
+sys.path.insert(0, {RAIZ!r})
+"""
+
+MEDIR_IMPORTACION = PREAMBULO + f"""
+t = time.perf_counter()
+importlib.import_module("app_ismr_sheets")
+ms = (time.perf_counter() - t) * 1000
+print(json.dumps({{"streamlit_ms": streamlit_ms, "ms": ms,
+                  "cargados": [m for m in {PESADOS!r} if m in sys.modules]}}))
+"""
+
+MEDIR_PRIMER_PINTADO = PREAMBULO + f"""
+from streamlit.testing.v1 import AppTest
+at = AppTest.from_file({APP!r}, default_timeout=60)
+t = time.perf_counter()
+at.run()
+ms = (time.perf_counter() - t) * 1000
+assert not at.exception and at.title[0].value.startswith("🔐"), "no se pintó el login"
+print(json.dumps({{"streamlit_ms": streamlit_ms, "ms": ms}}))
+"""
+
+
+def medir(codigo, directorio):
+    salida = subprocess.run([sys.executable, "-c", codigo], cwd=directorio, capture_output=True,
+                            text=True, check=True)
+    return json.loads(salida.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--repeticiones", type=int, default=5, help="procesos nuevos por medición")
+    parser.add_argument("--salida", help="archivo JSON de resultados (por defecto, solo el resumen)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="ismr-arranque-") as directorio:
+        os.makedirs(os.path.join(directorio, ".streamlit"))
+        with open(os.path.join(directorio, ".streamlit", "secrets.toml"), "w", encoding="utf-8") as f:
+            f.write("[gcp_service_account]\n"
+                    'client_email = "benchmark@ismr.invalid"\n')
+        importaciones = [medir(MEDIR_IMPORTACION, directorio) for _ in range(args.repeticiones)]
+        pintados = [medir(MEDIR_PRIMER_PINTADO, directorio) for _ in range(args.repeticiones)]
+
+    resultados = []
+    for operacion, muestras in [("importar_app", importaciones), ("primer_pintado_login", pintados)]:
+        tiempos = [m["ms"] for m in muestras]
+        resultados.append({
+            "operacion": operacion,
+            "repeticiones": len(tiempos),
+            "p50_ms": round(statistics.median(tiempos), 1),
+            "min_ms": round(min(tiempos), 1),
+            "max_ms": round(max(tiempos), 1),
+        })
+        print(f"{operacion:<24} p50 {resultados[-1]['p50_ms']:>8.1f} ms  "
+              f"min {resultados[-1]['min_ms']:>8.1f} ms  max {resultados[-1]['max_ms']:>8.1f} ms", file=sys.stderr)
+    print(f"{'import streamlit':<24} p50 {statistics.median(m['streamlit_ms'] for m in importaciones):>8.1f} ms",
+          file=sys.stderr)
+    print(f"cargados tras importar la app: {', '.join(importaciones[-1]['cargados']) or 'ninguno'}",
+          file=sys.stderr)
+
+    if args.salida:
+        informe = {
+            "fecha": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "plataforma": platform.platform(),
+            "parametros": vars(args),
+            "cargados_tras_importar": importaciones[-1]["cargados"],
+            "resultados": resultados,
+        }
+        with open(args.salida, "w", encoding="utf-8") as f:
+            f.write(json.dumps(informe, ensure_ascii=False, indent=2) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,297 @@
+"""
+Benchmark de escalamiento de la app ISMR, sin red: la app corre contra el
+gspread en memoria de gspread_falso.py, sembrado con N usuarios y N casos
+(N en la pestaña Individual y N/10 en Colectivo) para cada tamaño.
+
+Mide las funciones calientes de la app (login, registro de casos, carga,
+filtro, paginado y exportación del panel, cambio de contraseña) y escribe
+un JSON con p50/p95 y llamadas a la API por operación y tamaño. Con
+--comparar coteja contra un resultado anterior y termina con código 1 si
+alguna operación empeoró más que --tolerancia (y más de --umbral-ms).
+
+    python benchmarks/benchmark_ismr.py --tamanos 1000,10000 --salida actual.json
+    python benchmarks/benchmark_ismr.py --tamanos 1000,10000 --comparar base.json
+"""
+
+import argparse
+import functools
+import hashlib
+import json
+import logging
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import types
+from datetime import datetime, timedelta
+
+import numpy as np
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TAMANOS = [1000, 10000, 100000, 500000]
+
+# Recursos que la app guarda con st.cache_resource; fuera de `streamlit run`
+# esa caché no retiene nada, así que se reemplazan por versiones memorizadas
+FABRICAS = [
+    "metricas_rendimiento", "pool_sheets", "limitadores_sheets", "directorio_usuarios",
+    "pool_llamadas", "resumen_casos", "indice_filtros", "indice_ot_te", "exportar_casos",
+    "manifiesto_particiones",
+]
+
+DEPARTAMENTOS = ["Antioquia", "Bolívar", "Cauca", "Chocó", "Cundinamarca", "Meta",
+                 "Nariño", "Putumayo", "Santander", "Valle del Cauca"]
+SEXOS = ["Hombre", "Mujer", "Otro", "No Reporta"]
+SOLICITANTES = ["ARN", "SESP", "OTRO"]
+NIVELES = ["EXTRAORDINARIO", "EXTREMO", "ORDINARIO"]
+
+
+def importar_app(directorio):
+    """
+    Importa la app con secrets propios del benchmark. Streamlit busca el
+    archivo de secrets en el directorio actual al importarse.
+    """
+    os.makedirs(os.path.join(directorio, ".streamlit"), exist_ok=True)
+    with open(os.path.join(directorio, ".streamlit", "secrets.toml"), "w", encoding="utf-8") as f:
+        f.write("cuota_lecturas_minuto = 1000000000\n"
+                "cuota_escrituras_minuto = 1000000000\n"
+                'nivel_log = "WARNING"\n'
+                "[gcp_service_account]\n"
+                'client_email = "benchmark@ismr.invalid"\n')
+    os.chdir(directorio)
+    from streamlit import logger as st_logger
+    st_logger.set_log_level("error")
+    sys.path.insert(0, RAIZ)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import app_ismr_sheets
+    return app_ismr_sheets
+
+
+def caso(rng, i, inicio):
+    return [
+        (inicio + timedelta(minutes=i)).strftime("%Y-%m-%d %H:%M:%S"),
+        f"OT-{i:07d}",
+        str(rng.randint(1, 100)),
+        rng.choice(SEXOS),
+        (departamento := rng.choice(DEPARTAMENTOS)),
+        f"{departamento} {rng.randint(1, 40)}",
+        rng.choice(SOLICITANTES),
+        rng.choice(NIVELES),
+        "" if rng.random() < 0.7 else "Observación de prueba",
+        f"Analista {rng.randint(1, 25)}",
+        f"analista{rng.randint(1, 25)}",
+    ]
+
+
+def hash_clave(i):
+    return hashlib.sha256(f"clave{i}".encode()).hexdigest()
+
+
+class Escenario:
+    """Una app recién instalada contra un gspread falso sembrado con `n` filas."""
+
+    def __init__(self, app, originales, directorio, n, semilla, latencia, cuota):
+        import gspread
+        from gspread_falso import ApiFalsa, ClienteFalso, CredencialesFalsas
+
+        self.app = app
+        self.originales = originales
+        self.n = n
+        self.rng = random.Random(semilla)
+        self.resultados = []
+        self.api = ApiFalsa()
+        self.cliente = ClienteFalso(self.api)
+        self.siguiente_caso = n
+
+        inicio = datetime(2024, 1, 1)
+        usuarios = self.cliente.create("ISMR_Usuarios").sheet1
+        usuarios.filas = [list(app.ENCABEZADOS_USUARIOS)] + [
+            [f"usuario{i}", hash_clave(i), f"Usuario {i}", "FALSE", "FALSE"] for i in range(n)
+        ]
+        casos = self.cliente.create("ISMR_Casos")
+        for tab, cantidad in [("Individual", n), ("Colectivo", max(1, n // 10))]:
+            casos.add_worksheet(tab, rows=1000, cols=20, contar=False).filas = (
+                [list(app.ENCABEZADOS_CASOS)] + [caso(self.rng, i, inicio) for i in range(cantidad)]
+            )
+        self.api.llamadas.clear()
+        self.api.latencia = latencia
+        self.api.cuota_minuto = cuota
+
+        gspread.authorize = lambda credenciales, **kwargs: self.cliente
+        app.service_account = types.SimpleNamespace(Credentials=CredencialesFalsas)
+        for nombre in FABRICAS:
+            setattr(app, nombre, functools.lru_cache(maxsize=None)(originales[nombre]))
+        replica = app.ReplicaCasos(os.path.join(directorio, f"replica_{n}.db"))
+        bitacora = app.BitacoraCasos(os.path.join(directorio, f"bitacora_{n}.db"))
+        app.replica_casos = lambda: replica
+        app.bitacora_casos = lambda: bitacora
+        self.replica = replica
+        self.bitacora = bitacora
+
+    def medir(self, operacion, funcion, repeticiones, preparar=None):
+        tiempos, llamadas = [], []
+        for _ in range(repeticiones):
+            if preparar:
+                preparar()
+            antes = self.api.total()
+            inicio = time.perf_counter()
+            funcion()
+            tiempos.append(time.perf_counter() - inicio)
+            llamadas.append(self.api.total() - antes)
+        tiempos = np.array(tiempos) * 1000
+        self.resultados.append({
+            "tamano": self.n,
+            "operacion": operacion,
+            "repeticiones": repeticiones,
+            "p50_ms": round(float(np.percentile(tiempos, 50)), 3),
+            "p95_ms": round(float(np.percentile(tiempos, 95)), 3),
+            "min_ms": round(float(tiempos.min()), 3),
+            "llamadas_api": round(float(np.mean(llamadas)), 2),
+        })
+        r = self.resultados[-1]
+        print(f"{self.n:>8} {operacion:<36} p50 {r['p50_ms']:>10.2f} ms  "
+              f"p95 {r['p95_ms']:>10.2f} ms  api {r['llamadas_api']:>6}", file=sys.stderr)
+
+    def nuevo_caso(self):
+        self.siguiente_caso += 1
+        return caso(self.rng, self.siguiente_caso, datetime(2025, 1, 1))
+
+    def ejecutar(self, ligeras, pesadas):
+        app, rng, n = self.app, self.rng, self.n
+        usuario = lambda: rng.randrange(n)
+
+        # Login
+        self.medir("usuarios.cargar_directorio", app.cargar_directorio, pesadas,
+                   preparar=lambda: app.directorio_usuarios().invalidar())
+        self.medir("usuarios.obtener_usuario", lambda: app.obtener_usuario(f"usuario{usuario()}"), ligeras)
+        self.medir("usuarios.verificar_credenciales",
+                   lambda: app.verificar_credenciales(*(lambda i: (f"usuario{i}", f"clave{i}"))(usuario())),
+                   ligeras)
+
+        # Réplica del panel
+        recarga = app.RECARGA_COMPLETA_CADA
+        app.RECARGA_COMPLETA_CADA = 0
+        try:
+            self.medir("casos.sincronizar_completa", lambda: app.sincronizar_replica(self.replica), pesadas)
+        finally:
+            app.RECARGA_COMPLETA_CADA = recarga
+        individual = self.cliente.spreadsheets["ISMR_Casos"].pestanas["Individual"]
+        self.medir("casos.sincronizar_incremental", lambda: app.sincronizar_replica(self.replica), ligeras,
+                   preparar=lambda: individual.filas.extend(self.nuevo_caso() for _ in range(10)))
+
+        # Formulario: chequeo de duplicado y registro
+        self.medir("formulario.cargar_indice_ot_te", lambda: app.cargar_indice_ot_te("individual"), pesadas,
+                   preparar=lambda: setattr(app.indice_ot_te("individual"), "cargado_en", None))
+
+        def registrar():
+            fila = self.nuevo_caso()
+            indice = app.cargar_indice_ot_te("individual")
+            if indice.reservar(fila[1]):
+                self.bitacora.encolar("individual", fila[1], fila)
+                indice.confirmar(fila[1])
+        self.medir("formulario.registrar_caso", registrar, ligeras)
+        self.medir("formulario.rechazar_duplicado",
+                   lambda: app.cargar_indice_ot_te("individual").reservar(f"OT-{usuario():07d}"), ligeras)
+        self.medir("bitacora.enviar", lambda: app.enviar_bitacora(self.bitacora), pesadas,
+                   preparar=lambda: [registrar() for _ in range(50)])
+
+        # Panel: métricas, filtros, página y exportación
+        self.medir("panel.resumen", lambda: app.cargar_resumen(self.replica, "individual"), pesadas,
+                   preparar=lambda: setattr(app.resumen_casos("individual"), "cargado", False))
+        self.medir("panel.indice_filtros", lambda: app.cargar_indice_filtros(self.replica, "individual"), pesadas,
+                   preparar=lambda: setattr(app.indice_filtros("individual"), "cargado", False))
+        filtros = lambda: {"Departamento": rng.choice(DEPARTAMENTOS), "Nivel de Riesgo": rng.choice(NIVELES)}
+        indice = app.cargar_indice_filtros(self.replica, "individual")
+        self.medir("panel.filtrar", lambda: indice.filtrar(filtros()), ligeras)
+        self.medir("panel.pagina_ordenada", lambda: app.construir_dataframe_casos(
+            self.replica.pagina("individual", indice.filtrar(filtros()), orden="Edad", descendente=True)
+        ), ligeras)
+        version = self.replica.version("individual")
+        for formato in app.FORMATOS_EXPORTACION:
+            self.medir(f"panel.exportar_{formato.lower().replace(' ', '_')}",
+                       lambda: self.originales["exportar_casos"](self.replica, "individual", (), version, formato),
+                       pesadas)
+
+        # Cambio de contraseña
+        self.medir("usuarios.actualizar_password",
+                   lambda: app.actualizar_password(f"usuario{usuario()}", hash_clave(n + 1)), ligeras)
+
+
+def comparar(actual, base, tolerancia, umbral_ms):
+    """
+    Operaciones cuyo p50 empeoró más que `tolerancia` (fracción) y más de
+    `umbral_ms` frente a `base`; el umbral evita alarmas por ruido en las
+    operaciones de microsegundos.
+    """
+    anteriores = {(r["tamano"], r["operacion"]): r for r in base["resultados"]}
+    regresiones = []
+    for r in actual["resultados"]:
+        previo = anteriores.get((r["tamano"], r["operacion"]))
+        if (previo and previo["p50_ms"] > 0 and r["p50_ms"] > previo["p50_ms"] * (1 + tolerancia)
+                and r["p50_ms"] - previo["p50_ms"] > umbral_ms):
+            regresiones.append({**r, "p50_base_ms": previo["p50_ms"],
+                                "cambio": round(r["p50_ms"] / previo["p50_ms"] - 1, 3)})
+    return regresiones
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--tamanos", default=",".join(map(str, TAMANOS)),
+                        help="cantidades de casos y usuarios, separadas por comas")
+    parser.add_argument("--repeticiones", type=int, default=50, help="repeticiones de las operaciones rápidas")
+    parser.add_argument("--repeticiones-pesadas", type=int, default=3,
+                        help="repeticiones de las operaciones que recorren toda la hoja")
+    parser.add_argument("--latencia", type=float, default=0.0, help="segundos por llamada a la API falsa")
+    parser.add_argument("--cuota", type=int, default=0, help="llamadas por minuto antes de responder 429 (0 = sin límite)")
+    parser.add_argument("--semilla", type=int, default=2024)
+    parser.add_argument("--salida", help="archivo JSON de resultados (por defecto, stdout)")
+    parser.add_argument("--comparar", help="JSON de una corrida anterior contra el cual buscar regresiones")
+    parser.add_argument("--tolerancia", type=float, default=0.25,
+                        help="empeoramiento de p50 tolerado frente a --comparar (0.25 = 25%%)")
+    parser.add_argument("--umbral-ms", type=float, default=1.0,
+                        help="diferencia mínima de p50, en ms, para contar como regresión")
+    args = parser.parse_args()
+
+    base = None
+    if args.comparar:
+        with open(args.comparar, encoding="utf-8") as f:
+            base = json.load(f)
+    salida = os.path.abspath(args.salida) if args.salida else None
+
+    with tempfile.TemporaryDirectory(prefix="ismr-benchmark-") as directorio:
+        app = importar_app(directorio)
+        originales = {nombre: getattr(app, nombre).__wrapped__ for nombre in FABRICAS}
+        resultados = []
+        for n in (int(t) for t in args.tamanos.split(",")):
+            escenario = Escenario(app, originales, directorio, n, args.semilla, args.latencia, args.cuota)
+            escenario.ejecutar(args.repeticiones, args.repeticiones_pesadas)
+            resultados.extend(escenario.resultados)
+        os.chdir(RAIZ)
+
+    informe = {
+        "fecha": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "plataforma": platform.platform(),
+        "parametros": vars(args),
+        "resultados": resultados,
+    }
+    if base is not None:
+        informe["regresiones"] = comparar(informe, base, args.tolerancia, args.umbral_ms)
+
+    texto = json.dumps(informe, ensure_ascii=False, indent=2)
+    if salida:
+        with open(salida, "w", encoding="utf-8") as f:
+            f.write(texto + "\n")
+    else:
+        print(texto)
+
+    if informe.get("regresiones"):
+        for r in informe["regresiones"]:
+            print(f"REGRESIÓN {r['tamano']} {r['operacion']}: {r['p50_base_ms']} → {r['p50_ms']} ms "
+                  f"(+{r['cambio']:.0%})", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,228 @@
+"""
+Stand-in en memoria de gspread para los benchmarks: cliente, spreadsheets
+y pestañas con la parte de la API que usa la app, sin red.
+
+Cada llamada que en gspread real sería una petición HTTP pasa por
+ApiFalsa.llamada(), que la cuenta, espera la latencia configurada y, si
+se pasó la cuota por minuto, responde 429 como la API de Sheets.
+"""
+
+import time
+from collections import Counter, deque
+from datetime import datetime, timedelta
+
+import gspread
+from gspread.utils import a1_range_to_grid_range, a1_to_rowcol
+
+
+class _Respuesta:
+    """Lo mínimo de requests.Response que necesita gspread.exceptions.APIError."""
+
+    def __init__(self, codigo, mensaje):
+        self.status_code = codigo
+        self.text = mensaje
+
+    def json(self):
+        return {"error": {"code": self.status_code, "message": self.text, "status": "RESOURCE_EXHAUSTED"}}
+
+
+class ApiFalsa:
+    """Latencia por llamada (segundos) y cuota de llamadas por minuto (0 = sin límite)."""
+
+    def __init__(self, latencia=0.0, cuota_minuto=0):
+        self.latencia = latencia
+        self.cuota_minuto = cuota_minuto
+        self.llamadas = Counter()
+        self.ventana = deque()
+
+    def llamada(self, nombre):
+        self.llamadas[nombre] += 1
+        if self.cuota_minuto:
+            ahora = time.monotonic()
+            while self.ventana and ahora - self.ventana[0] > 60:
+                self.ventana.popleft()
+            if len(self.ventana) >= self.cuota_minuto:
+                raise gspread.exceptions.APIError(_Respuesta(429, "Quota exceeded"))
+            self.ventana.append(ahora)
+        if self.latencia:
+            time.sleep(self.latencia)
+
+    def total(self):
+        return sum(self.llamadas.values())
+
+
+def _recortar(filas):
+    """Como la API: sin celdas vacías al final de cada fila ni filas vacías al final."""
+    filas = [list(fila) for fila in filas]
+    for fila in filas:
+        while fila and fila[-1] == "":
+            fila.pop()
+    while filas and not filas[-1]:
+        filas.pop()
+    return filas
+
+
+class PestanaFalsa:
+    def __init__(self, spreadsheet, titulo, id_):
+        self.spreadsheet = spreadsheet
+        self.title = titulo
+        self.id = id_
+        self.filas = []
+
+    @property
+    def _api(self):
+        return self.spreadsheet.cliente.api
+
+    def _celda(self, fila, columna, valor):
+        while len(self.filas) < fila:
+            self.filas.append([])
+        actual = self.filas[fila - 1]
+        actual.extend([""] * (columna - len(actual)))
+        actual[columna - 1] = valor
+
+    def _escribir_rango(self, rango, valores):
+        fila, columna = a1_to_rowcol(rango.split(":")[0])
+        for i, valores_fila in enumerate(valores):
+            for j, valor in enumerate(valores_fila):
+                self._celda(fila + i, columna + j, valor)
+
+    def _leer_rango(self, rango):
+        grilla = a1_range_to_grid_range(rango)
+        desde = grilla.get("startRowIndex", 0)
+        hasta = grilla.get("endRowIndex", len(self.filas))
+        col_desde = grilla.get("startColumnIndex", 0)
+        col_hasta = grilla.get("endColumnIndex")
+        return _recortar(fila[col_desde:col_hasta] for fila in self.filas[desde:hasta])
+
+    def row_values(self, fila):
+        self._api.llamada("row_values")
+        return _recortar([self.filas[fila - 1]])[0] if fila <= len(self.filas) and self.filas[fila - 1] else []
+
+    def get_all_values(self):
+        self._api.llamada("get_all_values")
+        return _recortar(self.filas)
+
+    def get_all_records(self):
+        self._api.llamada("get_all_records")
+        filas = _recortar(self.filas)
+        if not filas:
+            return []
+        encabezados = filas[0]
+        return [dict(zip(encabezados, fila + [""] * (len(encabezados) - len(fila)))) for fila in filas[1:]]
+
+    def _respuesta_append(self, desde, columnas):
+        hasta = len(self.filas)
+        ultima = gspread.utils.rowcol_to_a1(hasta, max(columnas, 1))
+        return {"updates": {"updatedRange": f"'{self.title}'!A{desde}:{ultima}", "updatedRows": hasta - desde + 1}}
+
+    def append_row(self, fila, **kwargs):
+        self._api.llamada("append_row")
+        self.filas.append([str(v) for v in fila])
+        return self._respuesta_append(len(self.filas), len(fila))
+
+    def append_rows(self, filas, **kwargs):
+        self._api.llamada("append_rows")
+        desde = len(self.filas) + 1
+        self.filas.extend([str(v) for v in fila] for fila in filas)
+        return self._respuesta_append(desde, max((len(f) for f in filas), default=1))
+
+    def update(self, rango, valores, **kwargs):
+        self._api.llamada("update")
+        self._escribir_rango(rango, valores)
+
+    def update_cell(self, fila, columna, valor):
+        self._api.llamada("update_cell")
+        self._celda(fila, columna, str(valor))
+
+    def batch_update(self, datos, **kwargs):
+        self._api.llamada("batch_update")
+        for dato in datos:
+            self._escribir_rango(dato["range"], dato["values"])
+
+    def delete_rows(self, desde, hasta=None):
+        self._api.llamada("delete_rows")
+        del self.filas[desde - 1:(hasta or desde)]
+
+
+class SpreadsheetFalso:
+    def __init__(self, cliente, titulo):
+        self.cliente = cliente
+        self.title = titulo
+        self.id = f"id-{titulo}"
+        self.url = f"https://docs.google.com/spreadsheets/d/id-{titulo}"
+        self.pestanas = {}
+        self.add_worksheet("Hoja 1", rows=1000, cols=26, contar=False)
+
+    @property
+    def sheet1(self):
+        return next(iter(self.pestanas.values()))
+
+    def worksheet(self, titulo):
+        self.cliente.api.llamada("worksheet")
+        if titulo not in self.pestanas:
+            raise gspread.exceptions.WorksheetNotFound(titulo)
+        return self.pestanas[titulo]
+
+    def add_worksheet(self, title, rows, cols, contar=True):
+        if contar:
+            self.cliente.api.llamada("add_worksheet")
+        self.pestanas[title] = PestanaFalsa(self, title, len(self.pestanas))
+        return self.pestanas[title]
+
+    def share(self, *args, **kwargs):
+        self.cliente.api.llamada("share")
+
+    def values_batch_get(self, rangos, **kwargs):
+        self.cliente.api.llamada("values_batch_get")
+        respuesta = []
+        for rango in rangos:
+            titulo, a1 = rango.rsplit("!", 1)
+            valores = self.pestanas[titulo.strip("'")]._leer_rango(a1)
+            respuesta.append({"range": rango, "values": valores} if valores else {"range": rango})
+        return {"spreadsheetId": self.id, "valueRanges": respuesta}
+
+
+class _SesionFalsa:
+    def __init__(self):
+        self.hooks = {"response": []}
+
+    def close(self):
+        pass
+
+
+class ClienteFalso:
+    def __init__(self, api=None):
+        self.api = api or ApiFalsa()
+        self.spreadsheets = {}
+        self.session = _SesionFalsa()
+        self.timeout = None
+
+    def set_timeout(self, timeout):
+        self.timeout = timeout
+
+    def open(self, titulo):
+        self.api.llamada("open")
+        if titulo not in self.spreadsheets:
+            raise gspread.exceptions.SpreadsheetNotFound(titulo)
+        return self.spreadsheets[titulo]
+
+    def create(self, titulo):
+        self.api.llamada("create")
+        self.spreadsheets[titulo] = SpreadsheetFalso(self, titulo)
+        return self.spreadsheets[titulo]
+
+
+class CredencialesFalsas:
+    """Token siempre vigente: la app nunca intenta renovarlo."""
+
+    token = "token-falso"
+
+    def __init__(self):
+        self.expiry = datetime.utcnow() + timedelta(days=1)
+
+    @classmethod
+    def from_service_account_info(cls, info, scopes=None):
+        return cls()
+
+    def refresh(self, request):
+        pass